@@ -0,0 +1,240 @@
+"""
+Mask R-CNN
+Throughput benchmark and stage profiler of the training data generators.
+
+Runs data_generator_keypoint() or data_generator() on a dataset in one or
+more worker processes, without a model, and reports images per second and
+how the generator time splits across the loading and target building
+stages. Compare the rate with the training step rate to tell whether
+training is limited by the loader or by the model.
+
+Stages are timed by wrapping the dataset loaders and the utils/model
+functions the generators call. Time not spent in any stage, such as
+shuffling and batch packing of data_generator(), is reported as "other".
+
+Usage:
+    python bench_loader.py --dataset /path/to/cars --workers 4 --batches 50 \
+        --json results/loader_master.json
+"""
+
+import os
+import json
+import time
+import argparse
+import resource
+import functools
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import utils
+import model as modellib
+
+# Dataset methods and functions of the utils and model modules timed as
+# stages, in report order. Missing ones are skipped.
+DATASET_STAGES = ["load_molded", "load_image", "load_keypoints", "load_keypoints_compact",
+                  "load_mask", "load_mask_polygons"]
+UTILS_STAGES = ["resize_image", "resize_mask", "resize_keypoints", "resize_polygons",
+                "rasterize_polygons", "box_masks", "minimize_mask", "extract_bboxes"]
+MODEL_STAGES = ["build_rpn_targets"]
+
+
+class StageTimer(object):
+    """Accumulates the wall time and call count of named stages."""
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self.calls = OrderedDict()
+
+    def wrap(self, name, fn):
+        self.seconds.setdefault(name, 0.0)
+        self.calls.setdefault(name, 0)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.time() - start
+                self.calls[name] += 1
+        return timed
+
+
+def instrument(dataset, timer):
+    """Wraps the stages of the generators with the timer. Call it in the
+    process that runs the generator.
+    """
+    for name in DATASET_STAGES:
+        method = getattr(dataset, name, None)
+        if method is not None:
+            setattr(dataset, name, timer.wrap(name, method))
+    for name in UTILS_STAGES:
+        if hasattr(utils, name):
+            setattr(utils, name, timer.wrap(name, getattr(utils, name)))
+    for name in MODEL_STAGES:
+        setattr(modellib, name, timer.wrap(name, getattr(modellib, name)))
+    if hasattr(modellib, "BatchBuffers"):
+        modellib.BatchBuffers.add = timer.wrap("batch assembly", modellib.BatchBuffers.add)
+
+
+def make_generator(dataset, config, generator, batch_size):
+    if generator == "keypoint":
+        return modellib.data_generator_keypoint(dataset, config, shuffle=True, augment=False,
+                                                batch_size=batch_size)
+    return modellib.data_generator(dataset, config, shuffle=True, augment=False,
+                                   batch_size=batch_size)
+
+
+def _worker(dataset, config, generator, batch_size, batches, seed, results):
+    """Runs one generator for the given number of batches and reports its
+    stage times and peak RSS.
+    """
+    try:
+        np.random.seed(seed)
+        timer = StageTimer()
+        instrument(dataset, timer)
+        gen = make_generator(dataset, config, generator, batch_size)
+        # The first batch pays for one-time setup such as the anchors
+        next(gen)
+        for name in timer.seconds:
+            timer.seconds[name] = 0.0
+            timer.calls[name] = 0
+        start = time.time()
+        for _ in range(batches):
+            next(gen)
+        elapsed = time.time() - start
+        results.put({
+            "seconds": elapsed,
+            "images": batches * batch_size,
+            "stages": {name: (timer.seconds[name], timer.calls[name]) for name in timer.seconds},
+            # Kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        })
+    except Exception as e:
+        results.put({"error": repr(e)})
+
+
+def benchmark(dataset, config, generator="keypoint", workers=1, batches=20, batch_size=None):
+    """Runs the generator in worker processes and returns a dict of results.
+
+    generator: "keypoint" for data_generator_keypoint(), "mask" for
+        data_generator().
+    workers: Number of worker processes, each with its own generator.
+    batches: Batches timed per worker, after one warm-up batch.
+    """
+    batch_size = batch_size or config.BATCH_SIZE
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=_worker, args=(dataset, config, generator, batch_size, batches, i, results))
+        for i in range(workers)]
+    start = time.time()
+    for p in processes:
+        p.start()
+    reports = [results.get() for _ in processes]
+    wall = time.time() - start
+    for p in processes:
+        p.join()
+    errors = [r["error"] for r in reports if "error" in r]
+    if errors:
+        raise RuntimeError("Benchmark worker failed: {}".format(errors[0]))
+
+    busy = sum(r["seconds"] for r in reports)
+    images = sum(r["images"] for r in reports)
+    stages = OrderedDict()
+    for name in reports[0]["stages"]:
+        seconds = sum(r["stages"][name][0] for r in reports)
+        calls = sum(r["stages"][name][1] for r in reports)
+        if calls:
+            stages[name] = {"seconds": seconds, "calls": calls,
+                            "ms_per_image": 1000.0 * seconds / images,
+                            "fraction": seconds / busy}
+    other = busy - sum(s["seconds"] for s in stages.values())
+    stages["other"] = {"seconds": other, "calls": 0,
+                       "ms_per_image": 1000.0 * other / images, "fraction": other / busy}
+    return OrderedDict([
+        ("generator", generator),
+        ("workers", workers),
+        ("batch_size", batch_size),
+        ("images", images),
+        # Rate of each worker summed, so process start up doesn't count
+        ("images_per_second", sum(r["images"] / r["seconds"] for r in reports)),
+        ("wall_seconds", wall),
+        ("stages", stages),
+        ("peak_rss_mb", [r["peak_rss_mb"] for r in reports]),
+    ])
+
+
+def git_revision():
+    """Returns the commit of the working tree, to label results."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result):
+    print("{} generator, {} worker(s), batch size {}".format(
+        result["generator"], result["workers"], result["batch_size"]))
+    print("  {:.1f} images/s".format(result["images_per_second"]))
+    for name, stage in result["stages"].items():
+        print("  {:24s} {:8.2f} ms/image  {:5.1f}%".format(
+            name, stage["ms_per_image"], 100 * stage["fraction"]))
+    print("  peak RSS per worker: {} MB".format(
+        ", ".join("{:.0f}".format(m) for m in result["peak_rss_mb"])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the training data generators.')
+    parser.add_argument('--dataset', required=False, default=None,
+                        metavar="/path/to/cars/",
+                        help='Directory of the cars dataset')
+    parser.add_argument('--subset', default="train",
+                        help='Subset to load (default=train)')
+    parser.add_argument('--shards', default=None,
+                        metavar="/path/to/shards/",
+                        help='Benchmark pre-molded shards instead of the dataset')
+    parser.add_argument('--generator', default="keypoint", choices=["keypoint", "mask", "both"],
+                        help='data_generator_keypoint, data_generator or both')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batches', type=int, default=20,
+                        help='Batches timed per worker')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Defaults to the config BATCH_SIZE')
+    parser.add_argument('--json', default=None, metavar="results.json",
+                        help='Write the results to this JSON file')
+    args = parser.parse_args()
+    assert args.dataset or args.shards, "Provide --dataset or --shards"
+
+    import cars
+    import shards
+    config = cars.CarsConfig()
+    if args.shards:
+        dataset = shards.ShardDataset()
+        dataset.load_shards(args.shards, config)
+    else:
+        dataset = cars.CarsDataset()
+        dataset.load_cars(args.dataset, args.subset)
+    dataset.prepare()
+
+    generators = ["keypoint", "mask"] if args.generator == "both" else [args.generator]
+    output = OrderedDict([
+        ("revision", git_revision()),
+        ("config", config.NAME),
+        ("images_in_dataset", len(dataset.image_ids)),
+        ("results", []),
+    ])
+    for generator in generators:
+        result = benchmark(dataset, config, generator, workers=args.workers,
+                           batches=args.batches, batch_size=args.batch_size)
+        print_report(result)
+        output["results"].append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+        print("Wrote", args.json)
@@ -0,0 +1,102 @@
+"""
+Mask R-CNN
+Throughput of batch transport from loader processes to the trainer.
+
+Compares the pickled multiprocessing.Queue path that fit_generator uses
+with use_multiprocessing=True against shared_loader.SharedBatchLoader.
+Workers return synthetic batches with the shapes and dtypes of
+data_generator_keypoint() for the given config values, so only the
+transport is measured. Needs numpy only.
+
+Usage:
+    python bench_loader_transport.py --batch-size 2 --workers 4 --batches 200
+"""
+
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from shared_loader import SharedBatchLoader
+
+
+def synthetic_generator(args):
+    """Endless batches shaped like data_generator_keypoint() outputs."""
+    b = args.batch_size
+    num_anchors = args.anchors
+    inputs = [
+        np.random.rand(b, args.image_dim, args.image_dim, 3).astype(np.float32),
+        np.zeros((b, 1 + 3 + 4 + args.num_classes)),
+        np.zeros((b, num_anchors, 1), dtype=np.int32),
+        np.zeros((b, 256, 4)),
+        np.zeros((b, args.max_gt), dtype=np.int32),
+        np.zeros((b, args.max_gt, 4), dtype=np.int32),
+        np.zeros((b, args.max_gt, args.num_keypoints, 3)),
+        np.zeros((b, args.mini_mask, args.mini_mask, args.max_gt)),
+    ]
+    while True:
+        yield inputs, []
+
+
+def _queue_worker(args, seed, queue, stop):
+    np.random.seed(seed)
+    generator = synthetic_generator(args)
+    while not stop.is_set():
+        queue.put(next(generator))
+
+
+def bench_queue(args):
+    """Batches per second through a pickled multiprocessing.Queue, as in
+    Keras' GeneratorEnqueuer with use_multiprocessing=True.
+    """
+    queue = multiprocessing.Queue(maxsize=2 * args.workers)
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=_queue_worker, args=(args, i, queue, stop))
+               for i in range(args.workers)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for _ in range(args.workers):
+        queue.get()
+    start = time.time()
+    for _ in range(args.batches):
+        inputs, outputs = queue.get()
+    elapsed = time.time() - start
+    stop.set()
+    for w in workers:
+        w.terminate()
+    return args.batches / elapsed
+
+
+def bench_shared(args):
+    """Batches per second through SharedBatchLoader."""
+    loader = SharedBatchLoader(lambda: synthetic_generator(args), num_workers=args.workers)
+    for _ in range(args.workers):
+        next(loader)
+    start = time.time()
+    for _ in range(args.batches):
+        inputs, outputs = next(loader)
+    elapsed = time.time() - start
+    loader.close()
+    return args.batches / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark batch transport.')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batches', type=int, default=100)
+    parser.add_argument('--image-dim', type=int, default=1024)
+    parser.add_argument('--anchors', type=int, default=261888)
+    parser.add_argument('--max-gt', type=int, default=128)
+    parser.add_argument('--mini-mask', type=int, default=56)
+    parser.add_argument('--num-keypoints', type=int, default=1)
+    parser.add_argument('--num-classes', type=int, default=2)
+    args = parser.parse_args()
+
+    arrays = next(synthetic_generator(args))[0]
+    megabytes = sum(a.nbytes for a in arrays) / 2 ** 20
+    print("Batch size: {:.1f} MB".format(megabytes))
+    for name, bench in [("pickled queue", bench_queue), ("shared memory", bench_shared)]:
+        rate = bench(args)
+        print("{:14s} {:7.1f} batches/s  {:8.1f} MB/s".format(name + ":", rate, rate * megabytes))
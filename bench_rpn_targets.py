@@ -0,0 +1,149 @@
+"""
+Mask R-CNN
+Micro-benchmark of model.build_rpn_targets().
+
+Compares the vectorized implementation against the previous per-GT-box
+loop (kept below as reference_build_rpn_targets) on random GT boxes, checks
+that both return identical targets for the same random seed, and prints
+the time per image.
+
+Usage:
+    python bench_rpn_targets.py --gt-instances 128 --repeat 10
+"""
+
+import time
+import argparse
+import numpy as np
+
+import utils
+import model as modellib
+from config import Config
+
+
+class BenchConfig(Config):
+    NAME = "bench"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    MAX_GT_INSTANCES = 128
+
+
+def reference_build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+    """The loop based implementation build_rpn_targets() replaced."""
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_class_ids = gt_class_ids[non_crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        no_crowd_bool = (crowd_iou_max < 0.001)
+    else:
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+
+    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    gt_iou_argmax = np.argmax(overlaps, axis=0)
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                        np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+
+    ids = np.where(rpn_match == 1)[0]
+    ix = 0
+    for i, a in zip(ids, anchors[ids]):
+        gt = gt_boxes[anchor_iou_argmax[i]]
+        gt_h = gt[2] - gt[0]
+        gt_w = gt[3] - gt[1]
+        gt_center_y = gt[0] + 0.5 * gt_h
+        gt_center_x = gt[1] + 0.5 * gt_w
+        a_h = a[2] - a[0]
+        a_w = a[3] - a[1]
+        a_center_y = a[0] + 0.5 * a_h
+        a_center_x = a[1] + 0.5 * a_w
+        rpn_bbox[ix] = [
+            (gt_center_y - a_center_y) / a_h,
+            (gt_center_x - a_center_x) / a_w,
+            np.log(gt_h / a_h),
+            np.log(gt_w / a_w),
+        ]
+        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
+        ix += 1
+
+    return rpn_match, rpn_bbox
+
+
+def random_gt_boxes(config, count, rng):
+    """Returns [count] class IDs and [count, (y1, x1, y2, x2)] int32 boxes."""
+    height, width = config.IMAGE_SHAPE[:2]
+    h = rng.randint(8, height // 4, count)
+    w = rng.randint(8, width // 4, count)
+    y1 = rng.randint(0, height - h)
+    x1 = rng.randint(0, width - w)
+    boxes = np.stack([y1, x1, y1 + h, x1 + w], axis=1).astype(np.int32)
+    return np.ones([count], dtype=np.int32), boxes
+
+
+def time_call(fn, repeat):
+    start = time.time()
+    for i in range(repeat):
+        np.random.seed(i)
+        fn()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark build_rpn_targets().')
+    parser.add_argument('--gt-instances', type=int, default=BenchConfig.MAX_GT_INSTANCES,
+                        help='Number of GT boxes per image')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of calls to time')
+    args = parser.parse_args()
+
+    config = BenchConfig()
+    anchors = modellib.get_anchors(config).anchors
+    gt_class_ids, gt_boxes = random_gt_boxes(config, args.gt_instances,
+                                             np.random.RandomState(0))
+    print("Anchors: {}  GT boxes: {}".format(anchors.shape[0], gt_boxes.shape[0]))
+
+    # (name, RPN_SPARSE_OVERLAPS, prefilter)
+    modes = [("vectorized", False, False),
+             ("vectorized prefilter", False, True),
+             ("sparse", True, True)]
+
+    # Same seed, same targets
+    np.random.seed(0)
+    expected = reference_build_rpn_targets(config.IMAGE_SHAPE, anchors,
+                                           gt_class_ids, gt_boxes, config)
+    for name, sparse, prefilter in modes:
+        config.RPN_SPARSE_OVERLAPS = sparse
+        np.random.seed(0)
+        actual = modellib.build_rpn_targets(config.IMAGE_SHAPE, anchors, gt_class_ids,
+                                            gt_boxes, config, prefilter=prefilter)
+        assert np.array_equal(expected[0], actual[0]), "{}: rpn_match differs".format(name)
+        assert np.array_equal(expected[1], actual[1]), "{}: rpn_bbox differs".format(name)
+
+    reference = time_call(lambda: reference_build_rpn_targets(
+        config.IMAGE_SHAPE, anchors, gt_class_ids, gt_boxes, config), args.repeat)
+    print("{:22s} {:.1f} ms".format("reference:", reference * 1000))
+    for name, sparse, prefilter in modes:
+        config.RPN_SPARSE_OVERLAPS = sparse
+        t = time_call(lambda: modellib.build_rpn_targets(
+            config.IMAGE_SHAPE, anchors, gt_class_ids, gt_boxes, config,
+            prefilter=prefilter), args.repeat)
+        print("{:22s} {:.1f} ms  ({:.1f}x)".format(name + ":", t * 1000, reference / t))
@@ -29,6 +29,8 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
 import os
 import time
+import hashlib
+import collections
 import numpy as np
 import pdb
 import skimage
@@ -50,6 +52,8 @@ from config import Config
 import utils
 import model as modellib
 import video_dataset
+import shards
+import feature_cache
 import pickle
 
 import sys
@@ -98,6 +102,9 @@ class CarsConfig(Config):
     TRAIN_ROIS_PER_IMAGE = 100
     MAX_GT_INSTANCES = 128
     RPN_TRAIN_ANCHORS_PER_IMAGE = 150
+    RPN_SPARSE_OVERLAPS = True
+    COMPACT_BATCHES = True
+    LOADER_AUTOTUNE = True
     USE_MINI_MASK = True
     MASK_POOL_SIZE = 14
     KEYPOINT_MASK_POOL_SIZE = 7
@@ -105,6 +112,7 @@ class CarsConfig(Config):
     STEPS_PER_EPOCH = 1000
     WEIGHT_LOSS = True
     KEYPOINT_THRESHOLD = 0.005
+    KEYPOINT_DECODE_METHOD = "quadratic"
 
     # PART_STR = ["nose","left_eye","right_eye","left_ear","right_ear","left_shoulder",
     #             "right_shoulder","left_elbow","right_elbow","left_wrist","right_wrist",
@@ -115,6 +123,108 @@ class CarsConfig(Config):
 Person_ID = 1
 
 
+############################################################
+#  Dataset manifest
+############################################################
+
+# Bumped when the resolved image list changes for the same pickle, so older
+# manifests are rebuilt
+MANIFEST_VERSION = 2
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_manifest(manifest_path, pickle_path, images):
+    """Saves the image list resolved by CarsDataset.load_cars() as flat
+    arrays with offsets, keyed by the mtime and SHA-1 of the trajectory
+    pickle it was built from.
+
+    images: List of add_image() keyword arguments with keypoints and
+        contours annotations.
+    """
+    annotations = [a for image in images for a in image['annotations']]
+    contours = [np.asarray(c).reshape(-1, 2) for a in annotations for c in a['contours']]
+    stat = os.stat(pickle_path)
+    arrays = dict(
+        version=np.int64(MANIFEST_VERSION),
+        pickle_mtime=np.int64(stat.st_mtime_ns),
+        pickle_size=np.int64(stat.st_size),
+        pickle_sha1=np.array(_file_sha1(pickle_path)),
+        image_ids=np.array([str(image['image_id']) for image in images]),
+        paths=np.array([str(image['path']) for image in images]),
+        sides=np.array([image['side'] for image in images]),
+        widths=np.array([image['width'] for image in images], dtype=np.int64),
+        heights=np.array([image['height'] for image in images], dtype=np.int64),
+        frames=np.array([image['frame'] for image in images], dtype=np.int64),
+        # Image i owns annotations [annotation_offsets[i], annotation_offsets[i + 1])
+        annotation_offsets=np.cumsum([0] + [len(image['annotations']) for image in images]),
+        keypoints=np.array([np.asarray(a['keypoints']).ravel()[:2] for a in annotations],
+                           dtype=np.uint16).reshape(-1, 2),
+        contour_offsets=np.cumsum([0] + [len(a['contours']) for a in annotations]),
+        vertex_offsets=np.cumsum([0] + [len(c) for c in contours]),
+        vertices=np.concatenate(contours) if contours else np.zeros([0, 2]),
+    )
+    # Write to a temporary file and rename it, so a reader never sees a
+    # partial manifest.
+    tmp_path = "{}.{}.tmp.npz".format(manifest_path[:-4], os.getpid())
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, manifest_path)
+
+
+def read_manifest(manifest_path, pickle_path):
+    """Loads an image list saved by write_manifest().
+
+    Returns the list of add_image() keyword arguments, or None if there is
+    no manifest or the pickle changed since it was written. A pickle with a
+    new mtime but the same content still matches.
+    """
+    if not os.path.exists(manifest_path) or not os.path.exists(pickle_path):
+        return None
+    with np.load(manifest_path) as m:
+        stat = os.stat(pickle_path)
+        if 'version' not in m.files or int(m['version']) != MANIFEST_VERSION:
+            return None
+        if int(m['pickle_size']) != stat.st_size:
+            return None
+        touched = int(m['pickle_mtime']) != stat.st_mtime_ns
+        if touched and str(m['pickle_sha1']) != _file_sha1(pickle_path):
+            return None
+        m = {name: m[name] for name in m.files}
+    if touched:
+        # Same content. Record the new mtime so later loads skip the hash.
+        m['pickle_mtime'] = np.int64(stat.st_mtime_ns)
+        tmp_path = "{}.{}.tmp.npz".format(manifest_path[:-4], os.getpid())
+        try:
+            np.savez(tmp_path, **m)
+            os.replace(tmp_path, manifest_path)
+        except OSError:
+            pass
+
+    vertices = np.split(m['vertices'], m['vertex_offsets'][1:-1])
+    contour_offsets = m['contour_offsets']
+    annotations = [{'keypoints': m['keypoints'][a],
+                    'contours': vertices[contour_offsets[a]:contour_offsets[a + 1]]}
+                   for a in range(len(m['keypoints']))]
+    annotation_offsets = m['annotation_offsets']
+    images = []
+    for i in range(len(m['image_ids'])):
+        side = m['sides'][i]
+        images.append(dict(
+            image_id=str(m['image_ids'][i]),
+            path=str(m['paths'][i]),
+            side=side.item(),
+            width=int(m['widths'][i]),
+            height=int(m['heights'][i]),
+            frame=int(m['frames'][i]),
+            annotations=annotations[annotation_offsets[i]:annotation_offsets[i + 1]]))
+    return images
+
+
 ############################################################
 #  Dataset
 ############################################################
@@ -131,24 +241,50 @@ class CarsDataset(utils.Dataset):
         # "left_hip","right_hip","left_knee","right_knee","left_ankle","right_ankle"]
         # self._keypoint_names = []
         super().__init__(class_map)
-    def load_cars(self, dataset_dir, subset, class_ids=None):
+    def load_cars(self, dataset_dir, subset, class_ids=None, merge_frames=False,
+                  manifest=True):
         """Load a subset of the COCO dataset.
         dataset_dir: The root directory of the COCO dataset.
         subset: What to load (train, val, minival, valminusminival)
         class_ids: If provided, only loads images that have the given classes.
+        merge_frames: If True, annotations of different trajectories in the
+            same video frame, keyed by (video path, side, absolute frame),
+            become one image with all of their instances. Otherwise each
+            annotated frame of each trajectory is its own image. Either way
+            images read the absolute video frame of their annotations.
+        manifest: If True, the resolved image list is cached in a manifest
+            next to the trajectory pickle (see write_manifest()) and later
+            calls load it instead of unpickling the trajectories.
         """
-
-        trajs = sum(pickle.load(open('all_results.p', 'rb')), [])
-
-        # f = open(os.path.join(dataset_dir, subset + '.txt'), 'r')
-        # video_files = [x.strip() for x in f.readlines()]
-        # dataset = video_dataset.Dataset_from_videos(video_files)
+        pickle_path = 'all_results.p'
+        manifest_path = "{}.{}.manifest.npz".format(
+            os.path.splitext(pickle_path)[0], "merged" if merge_frames else "frames")
 
         # Add classes
         self.add_class("car", 1, "car")
 
+        images = read_manifest(manifest_path, pickle_path) if manifest else None
+        if images is None:
+            trajs = sum(pickle.load(open(pickle_path, 'rb')), [])
+            images = self._trajectory_images(trajs, merge_frames)
+            if manifest:
+                write_manifest(manifest_path, pickle_path, images)
+
         # Add images
+        for image in images:
+            self.add_image("car", **image)
+
+    def _trajectory_images(self, trajs, merge_frames):
+        """Resolves the annotated frames of car trajectories into a list of
+        add_image() keyword arguments.
+        """
+        # f = open(os.path.join(dataset_dir, subset + '.txt'), 'r')
+        # video_files = [x.strip() for x in f.readlines()]
+        # dataset = video_dataset.Dataset_from_videos(video_files)
 
+        images = []
+        # Same-frame annotations, in order of their first appearance
+        merged = collections.OrderedDict()
         for j, (annot_id, traj) in enumerate(trajs):
             if traj.class_name == "car":
                 if traj.manual_annotations is not None:
@@ -161,17 +297,37 @@ class CarsDataset(utils.Dataset):
                         points_2d[:, :2] = points_2d[:, :2] / points_2d[:, 2].reshape((-1, 1))
                         keypoint = points_2d.astype('uint16').ravel()[:2]
                         contours = traj.contours[traj.local_frame(i + traj.manual_annotations_start)]
+                        annotation = {'keypoints': keypoint, 'contours': contours}
 
-                        self.add_image(
-                                "car",
+                        if merge_frames:
+                            key = (traj.video.avi_list[0], traj.side, i + traj.manual_annotations_start)
+                            if key not in merged:
+                                merged[key] = {'image_id': '%i_%i' % (j, i), 'shape': shape,
+                                               'annotations': []}
+                            merged[key]['annotations'].append(annotation)
+                            continue
+
+                        images.append(dict(
                                 image_id = '%i_%i' % (j, i),
                                 path = traj.video.avi_list[0],
                                 side = traj.side,
                                 width = shape[0],
                                 height = shape[1],
-                                frame = i,
-                                annotations = [{'keypoints': keypoint, 'contours': contours}]
-                                )
+                                frame = i + traj.manual_annotations_start,
+                                annotations = [annotation]
+                                ))
+
+        for (path, side, frame), image in merged.items():
+            images.append(dict(
+                    image_id = image['image_id'],
+                    path = path,
+                    side = side,
+                    width = image['shape'][0],
+                    height = image['shape'][1],
+                    frame = frame,
+                    annotations = image['annotations']
+                    ))
+        return images
 
                 # while metadata is not None:
                 #     self.add_image(
@@ -273,6 +429,18 @@ class CarsDataset(utils.Dataset):
         ##     return super(CocoDataset, self).load_mask(image_id)
 
 
+    def load_mask_polygons(self, image_id):
+        """Return the contours of the instances of the given image, so
+        load_image_gt() can draw masks at training resolution.
+
+        Returns:
+        polygons: One list of [num_vertices, (x, y)] contours per instance.
+        class_ids: a 1D array of class IDs of the instances.
+        """
+        info = self.image_info[image_id]
+        polygons = [list(annot['contours']) for annot in info['annotations']]
+        return polygons, np.ones([len(polygons)], dtype=np.int32)
+
     def load_keypoints(self, image_id):
         """Load person keypoints for the given image.
 
@@ -347,6 +515,25 @@ class CarsDataset(utils.Dataset):
         ###     # Call super class to return an empty mask
         ###     return super(CocoDataset, self).load_keypoints(image_id)
 
+    def load_keypoints_compact(self, image_id):
+        """Load the keypoint of each car and a one pixel box at it, without
+        the full size masks of load_keypoints().
+
+        Returns:
+        keypoints: [num_cars, 1, (x, y, v)]
+        bbox: [num_cars, (y1, x1, y2, x2)]
+        class_ids: a 1D array of class IDs of the cars.
+        """
+        info = self.image_info[image_id]
+        num_cars = len(info['annotations'])
+        keypoints = np.zeros((num_cars, 1, 3))
+        bbox = np.zeros((num_cars, 4), dtype=np.int32)
+        for i, annot in enumerate(info['annotations']):
+            x, y = annot['keypoints'].ravel()[:2]
+            keypoints[i, 0, :] = [x, y, 1]
+            bbox[i] = [y, x, y + 1, x + 1]
+        return keypoints, bbox, np.ones([num_cars], dtype=np.int32)
+
     def image_reference(self, image_id):
         """Return a link to the image in the COCO Website."""
         info = self.image_info[image_id]
@@ -480,7 +667,7 @@ if __name__ == '__main__':
         description='Train Mask R-CNN on MS COCO.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'evaluate' on MS COCO")
+                        help="'train', 'preprocess' or 'evaluate' on MS COCO")
     parser.add_argument('--dataset', required=True,
                         metavar="/path/to/coco/",
                         help='Directory of the MS-COCO dataset')
@@ -495,6 +682,25 @@ if __name__ == '__main__':
                         default=500,
                         metavar="<image count>",
                         help='Images to use for evaluation (default=500)')
+    parser.add_argument('--frame-cache', required=False,
+                        default=None,
+                        metavar="/path/to/frame/cache/",
+                        help='Keep decoded training frames in a memory-mapped cache in this directory')
+    parser.add_argument('--frame-cache-mb', required=False,
+                        default=0, type=int,
+                        metavar="<megabytes>",
+                        help='In-memory frame cache budget per process (default=0, disabled)')
+    parser.add_argument('--shards', required=False,
+                        default=None,
+                        metavar="/path/to/shards/",
+                        help="Pre-molded training shards. Written by 'preprocess', read by 'train'")
+    parser.add_argument('--merge-frames', required=False,
+                        action='store_true',
+                        help='Load all cars annotated in a video frame as one image')
+    parser.add_argument('--feature-cache', required=False,
+                        default=None,
+                        metavar="/path/to/feature/cache/",
+                        help='Train the heads stage on backbone features cached in this directory')
     args = parser.parse_args()
     print("Command: ", args.command)
     print("Model: ", args.model)
@@ -502,7 +708,7 @@ if __name__ == '__main__':
     print("Logs: ", args.logs)
 
     # Configurations
-    if args.command == "train":
+    if args.command in ["train", "preprocess"]:
         config = CarsConfig()
     else:
         class InferenceConfig(CocoConfig):
@@ -514,6 +720,16 @@ if __name__ == '__main__':
         config = InferenceConfig()
     config.display()
 
+    # Mold the training set once and exit. Doesn't need a model.
+    if args.command == "preprocess":
+        assert args.shards, "Provide --shards to write to"
+        dataset_train = CarsDataset()
+        dataset_train.load_cars(args.dataset, "train", merge_frames=args.merge_frames)
+        dataset_train.prepare()
+        count = shards.write_shards(dataset_train, config, args.shards)
+        print("Wrote {} pre-molded images to {}".format(count, args.shards))
+        sys.exit(0)
+
     # Create model
     if args.command == "train":
         model = modellib.MaskRCNN(mode="training", config=config,
@@ -542,25 +758,59 @@ if __name__ == '__main__':
     if args.command == "train":
         # Training dataset. Use the training set and 35K from the
         # validation set, as as in the Mask RCNN paper.
-        dataset_train = CarsDataset()
-        dataset_train.load_cars(args.dataset, "train")
+        if args.shards:
+            dataset_train = shards.ShardDataset()
+            dataset_train.load_shards(args.shards, config)
+        else:
+            dataset_train = CarsDataset()
+            dataset_train.load_cars(args.dataset, "train", merge_frames=args.merge_frames)
         # dataset_train.load_cars(args.dataset, "valminusminival", year=args.year, auto_download=args.download)
         dataset_train.prepare()
+        if args.frame_cache or args.frame_cache_mb:
+            dataset_train.enable_frame_cache(max_bytes=args.frame_cache_mb << 20,
+                                             cache_dir=args.frame_cache)
         pdb.set_trace()
 
         # Validation dataset
         dataset_val = CarsDataset()
-        dataset_val.load_cars(args.dataset, "minival")
+        dataset_val.load_cars(args.dataset, "minival", merge_frames=args.merge_frames)
         dataset_val.prepare()
 
         # *** This training schedule is an example. Update to your needs ***
 
         # Training - Stage 1
         print("Training network heads")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE,
-                    epochs=40,
-                    layers='heads')
+        if args.feature_cache:
+            # The backbone is frozen, so run it once per image and train the
+            # heads of a model without it on the cached features.
+            feature_cache.build_feature_cache(model, dataset_train, args.feature_cache)
+            feature_cache.build_feature_cache(model, dataset_val, args.feature_cache)
+            heads_config = CarsConfig()
+            heads_config.FEATURE_CACHE_DIR = args.feature_cache
+            # Batches of features are large. Don't pickle them.
+            heads_config.DATA_LOADER = "shared_memory"
+            heads_model = modellib.MaskRCNN(mode="training", config=heads_config,
+                                            model_dir=args.logs)
+            # Log to the run of the full model. Its checkpoints lack the
+            # backbone, so they get a prefix that find_last() skips.
+            heads_model.log_dir = model.log_dir
+            heads_model.checkpoint_path = os.path.join(
+                model.log_dir, "heads_" + os.path.basename(model.checkpoint_path))
+            feature_cache.copy_weights(model, heads_model)
+            heads_model.epoch = model.epoch
+            heads_model.train(dataset_train, dataset_val,
+                              learning_rate=config.LEARNING_RATE,
+                              epochs=40,
+                              layers='heads')
+            feature_cache.copy_weights(heads_model, model)
+            model.epoch = heads_model.epoch
+            # A complete checkpoint of the stage, named like Keras names them
+            model.keras_model.save_weights(model.checkpoint_path.format(epoch=model.epoch))
+        else:
+            model.train(dataset_train, dataset_val,
+                        learning_rate=config.LEARNING_RATE,
+                        epochs=40,
+                        layers='heads')
 
         # Training - Stage 2
         # Finetune layers from ResNet stage 4 and up
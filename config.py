@@ -34,6 +34,47 @@ class Config(object):
     # number that your GPU can handle for best performance.
     IMAGES_PER_GPU = 2
 
+    # How training batches reach fit_generator()
+    # "keras": Keras worker processes, batches are pickled back.
+    # "shared_memory": Worker processes fill a ring of shared-memory batch
+    #     slots that the trainer reads without copies. See shared_loader.py
+    # "sequence": Workers build batches by index from a per-epoch
+    #     permutation, so each epoch visits every image once.
+    #     See model.KeypointSequence
+    DATA_LOADER = "keras"
+
+    # If True, training batches use compact dtypes: uint8 images that the
+    # model molds in the graph, bool masks and int16 keypoints. Cuts the
+    # memory traffic of the data generators several times.
+    # See model.BatchBuffers
+    COMPACT_BATCHES = False
+
+    # If True, train() times a few batches of the data generator and a few
+    # training steps first, and picks the number of loader workers and the
+    # queue size from them. The batches in the queue and in the workers are
+    # kept within LOADER_MEMORY_BUDGET_MB. Otherwise BATCH_SIZE // 2 workers
+    # (at least 2) and a queue of 100 batches are used.
+    # See model.choose_loader_size()
+    LOADER_AUTOTUNE = False
+    LOADER_MEMORY_BUDGET_MB = 4096
+
+    # If True, train() records the time each step waits for data, the time
+    # inside the step, the generator queue depth and the losses, as
+    # TensorBoard scalars and a timeline.csv in the log directory.
+    # See step_timeline.py
+    STEP_TIMELINE = False
+
+    # Directory of cached backbone features. If set, a training model is
+    # built without the ResNet backbone: it takes the float16 C2-C5 features
+    # of each image as inputs, and train() reads them from the stores that
+    # feature_cache.build_feature_cache() wrote there. Only for training the
+    # heads, whose backbone is frozen. See feature_cache.py
+    # Frames aren't decoded then, but each image reads about 60 MB of
+    # features at 1024x1024, so keep the stores on a fast disk or in the page
+    # cache, and use DATA_LOADER = "shared_memory": with "keras" every batch
+    # of features is pickled through a queue.
+    FEATURE_CACHE_DIR = None
+
     # Number of training steps per epoch
     # This doesn't need to match the size of the training set. Tensorboard
     # updates are saved at the end of each epoch, so setting this to a
@@ -41,8 +82,14 @@ class Config(object):
     # Validation stats are also calculated at each epoch end and they
     # might take a while, so don't set this too small to avoid spending
     # a lot of time on validation stats.
+    # None makes an epoch one pass over the usable training images.
     STEPS_PER_EPOCH = 5000
 
+    # Directory of the instance index of each dataset. If set, train() scans
+    # each dataset once, saves which images have usable instances there and
+    # only samples those. See model.build_instance_index()
+    INSTANCE_INDEX_DIR = None
+
     # Number of validation steps to run at the end of every training epoch.
     # A bigger number improves accuracy of validation stats, but slows
     # down the training.
@@ -57,6 +104,12 @@ class Config(object):
 
     NUM_KEYPOINTS = 17 #Override in sub-classes
 
+    # How detected keypoints are decoded from their heatmaps. "argmax" takes
+    # the peak cell rounded to whole pixels, "soft_argmax" and "quadratic"
+    # refine the peak to sub-pixel float coordinates.
+    # See utils.decode_keypoint_heatmaps()
+    KEYPOINT_DECODE_METHOD = "argmax"
+
     # Length of square anchor side in pixels
     RPN_ANCHOR_SCALES = (32, 64, 128, 256, 512)
 
@@ -69,6 +122,10 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Directory where the generated pyramid anchors are saved as .npy files
+    # and loaded from by other processes. None keeps them in memory only.
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can reduce this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
@@ -76,6 +133,12 @@ class Config(object):
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
 
+    # If True, RPN targets compute anchor/GT IoU only for pairs that can
+    # intersect, found from the anchor grid of each pyramid level. Same
+    # targets, but memory scales with the overlaps instead of anchors times
+    # GT boxes. Useful with a large MAX_GT_INSTANCES.
+    RPN_SPARSE_OVERLAPS = False
+
     # ROIs kept after non-maximum supression (training and inference)
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
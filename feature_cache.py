@@ -0,0 +1,209 @@
+"""
+Mask R-CNN
+Cached backbone features for heads-only training.
+
+With layers='heads' the ResNet backbone is frozen and its batch norm layers
+run in inference mode, so the C2-C5 features of an unaugmented image are
+the same in every epoch. build_feature_cache() runs the backbone once over
+a dataset and stores the features as float16 .npy files, one per level,
+that FeatureStore reads back memory-mapped.
+
+A model built with config.FEATURE_CACHE_DIR set takes the C2-C5 features
+as inputs instead of the image and has no backbone, and train() feeds it
+from the stores. The FPN stays in the graph because 'heads' trains it.
+
+The features take about 60 MB per 1024x1024 image on disk, so this pays off
+when the page cache or a fast disk can hold them. The loaders then build
+only the targets of each image and don't decode its frame.
+
+Usage:
+    model = modellib.MaskRCNN(mode="training", config=config, model_dir=logs)
+    model.load_weights(...)
+    feature_cache.build_feature_cache(model, dataset_train, cache_dir)
+
+    heads_config.FEATURE_CACHE_DIR = cache_dir
+    heads = modellib.MaskRCNN(mode="training", config=heads_config, model_dir=logs)
+    feature_cache.copy_weights(model, heads)
+    heads.train(dataset_train, dataset_val, learning_rate, epochs, layers="heads")
+    feature_cache.copy_weights(heads, model)
+    model.keras_model.save_weights(model.checkpoint_path.format(epoch=epochs))
+
+Checkpoints of the heads model have no backbone weights. Keep them out of
+find_last(), as cars.py does, and save the full model after copying the
+heads back.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+import numpy as np
+import keras.models as KM
+
+import model as modellib
+
+# File names of the feature levels in a store
+LEVELS = ["c2", "c3", "c4", "c5"]
+
+
+def _inner_model(model):
+    """Returns the Keras model of a MaskRCNN, unwrapping a ParallelModel."""
+    keras_model = model.keras_model
+    return keras_model.inner_model if hasattr(keras_model, "inner_model") else keras_model
+
+
+def trunk_model(model):
+    """Returns a Keras model from the input image of a training-mode
+    MaskRCNN to its C2-C5 features. It shares the weights of the model.
+    """
+    keras_model = _inner_model(model)
+    return KM.Model(keras_model.get_layer("input_image").output,
+                    [keras_model.get_layer(name).output
+                     for name in modellib.BACKBONE_FEATURE_LAYERS],
+                    name="backbone_trunk")
+
+
+def weights_signature(trunk):
+    """SHA-1 of the backbone weights. Features of other weights are stale."""
+    sha1 = hashlib.sha1()
+    for w in trunk.get_weights():
+        sha1.update(np.ascontiguousarray(w).tobytes())
+    return sha1.hexdigest()
+
+
+def store_directory(cache_dir, dataset, config):
+    """Directory of the feature store of a dataset, keyed by its images and
+    the config values that decide them.
+    """
+    return os.path.join(cache_dir, "features_{}".format(
+        modellib.dataset_signature(dataset, config)))
+
+
+def copy_weights(source, target):
+    """Copies the weights of the layers of source that target also has, by
+    layer name. Moves the heads between a full model and one built with
+    config.FEATURE_CACHE_DIR.
+    """
+    target_layers = {l.name: l for l in _inner_model(target).layers}
+    for layer in _inner_model(source).layers:
+        if layer.weights and layer.name in target_layers:
+            target_layers[layer.name].set_weights(layer.get_weights())
+
+
+class FeatureStore(object):
+    """Read access to the cached features of a dataset.
+
+    directory: A store written by build_feature_cache().
+
+    The .npy files are opened memory-mapped on first use in each process,
+    so a store can be passed to data loader workers cheaply.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.weights_signature = meta["weights_signature"]
+        self.shapes = [tuple(shape) for shape in meta["shapes"]]
+        self.rows = {image_id: row for row, image_id in enumerate(meta["image_ids"])}
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __contains__(self, image_id):
+        return int(image_id) in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def features(self, image_id):
+        """Returns the [C2, C3, C4, C5] float16 features of an image."""
+        if self._arrays is None:
+            self._arrays = [np.load(os.path.join(self.directory, level + ".npy"), mmap_mode="r")
+                            for level in LEVELS]
+        row = self.rows[int(image_id)]
+        return [a[row] for a in self._arrays]
+
+
+def build_feature_cache(model, dataset, cache_dir, image_ids=None, batch_size=None):
+    """Runs the backbone of a training-mode MaskRCNN over the unaugmented
+    images of a dataset and stores the C2-C5 features under cache_dir.
+
+    image_ids: The images to cache. Defaults to the images train() samples
+        from, see model.usable_image_ids().
+    batch_size: Images per backbone forward pass. Defaults to the config
+        BATCH_SIZE.
+
+    An existing store of the same images and backbone weights is reused.
+    Returns the FeatureStore.
+    """
+    config = model.config
+    assert not config.FEATURE_CACHE_DIR, "Needs a model with a backbone"
+    directory = store_directory(cache_dir, dataset, config)
+    image_ids = modellib.usable_image_ids(dataset, config) if image_ids is None \
+        else np.asarray(image_ids)
+    image_ids = [int(i) for i in image_ids]
+    trunk = trunk_model(model)
+    signature = weights_signature(trunk)
+
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        store = FeatureStore(directory)
+        if store.weights_signature == signature and all(i in store for i in image_ids):
+            modellib.log("Using cached features in {}".format(directory))
+            return store
+        shutil.rmtree(directory)
+
+    modellib.log("Caching backbone features of {} images in {}".format(
+        len(image_ids), directory))
+    os.makedirs(directory, exist_ok=True)
+    shapes = modellib.backbone_feature_shapes(config)
+    arrays = [np.lib.format.open_memmap(os.path.join(directory, level + ".npy"), mode="w+",
+                                        dtype=np.float16, shape=(len(image_ids),) + shape)
+              for level, shape in zip(LEVELS, shapes)]
+    batch_size = batch_size or config.BATCH_SIZE
+    for start in range(0, len(image_ids), batch_size):
+        batch_ids = image_ids[start:start + batch_size]
+        images = []
+        for image_id in batch_ids:
+            try:
+                image = modellib.load_image_gt_keypoints(
+                    dataset, config, image_id, augment=False,
+                    use_mini_mask=config.USE_MINI_MASK)[0]
+            except Exception:
+                # The generators skip this image too. Cache a blank one.
+                logging.exception("Error processing image {}".format(
+                    dataset.image_info[image_id]))
+                image = np.zeros(config.IMAGE_SHAPE, dtype=np.uint8)
+            if not config.COMPACT_BATCHES:
+                # Only the compact model molds images in the graph
+                image = modellib.mold_image(image.astype(np.float32), config)
+            images.append(image)
+        features = trunk.predict_on_batch(np.stack(images))
+        for a, feature in zip(arrays, features):
+            a[start:start + len(batch_ids)] = feature
+    for a in arrays:
+        a.flush()
+    del arrays
+
+    # The metadata goes last. A store without it is incomplete.
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"image_ids": image_ids, "weights_signature": signature,
+                   "shapes": [list(shape) for shape in shapes]}, f)
+    return FeatureStore(directory)
+
+
+def open_store(cache_dir, dataset, config):
+    """Returns the FeatureStore of a dataset, written by
+    build_feature_cache() with the same images and config.
+    """
+    directory = store_directory(cache_dir, dataset, config)
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        raise FileNotFoundError(
+            "No feature cache of this dataset in {}. Run build_feature_cache() "
+            "first.".format(cache_dir))
+    return FeatureStore(directory)
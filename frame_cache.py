@@ -0,0 +1,157 @@
+"""
+Mask R-CNN
+Decoded-frame cache for video backed datasets.
+
+Every training epoch visits the same annotated frames again, and decoding
+them from the AVI files is the most expensive part of Dataset.load_image().
+The FrameCache keeps decoded (already split L/R) frames around in two tiers:
+
+- A bounded in-memory tier with a byte budget and LRU eviction.
+- An optional on-disk tier: one memory-mapped file holding a fixed-size
+  uint8 slot per image_id, plus a flag array marking the filled slots.
+  It survives between epochs and runs, and because the mapping is shared,
+  frames written by one Keras worker process are visible to the others.
+
+Usage:
+    dataset.prepare()
+    dataset.enable_frame_cache(max_bytes=4 << 30, cache_dir="/scratch/frames")
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class FrameCache(object):
+    """Two-tier cache of decoded frames indexed by image_id.
+
+    max_bytes: Byte budget of the in-memory tier. 0 disables it.
+    cache_dir: If given, directory of the memory-mapped on-disk tier.
+    num_images: Number of slots of the on-disk tier (len(dataset.image_ids)).
+    frame_shape: [height, width, 3] shape of every cached frame. Frames of
+        a different shape are only kept in memory.
+    key: String identifying the image list. An on-disk tier written for
+        a different key is discarded.
+    """
+
+    def __init__(self, max_bytes=1 << 30, cache_dir=None, num_images=None,
+                 frame_shape=None, key=""):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.frame_shape = tuple(frame_shape) if frame_shape is not None else None
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._frames = None
+        self._valid = None
+
+        # Hit and miss counters
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if cache_dir:
+            assert num_images is not None and self.frame_shape is not None, \
+                "The on-disk tier needs num_images and frame_shape"
+            self._open_disk_tier(cache_dir, num_images, key)
+
+    def _open_disk_tier(self, cache_dir, num_images, key):
+        os.makedirs(cache_dir, exist_ok=True)
+        index_path = os.path.join(cache_dir, "index.json")
+        frames_path = os.path.join(cache_dir, "frames.npy")
+        valid_path = os.path.join(cache_dir, "valid.npy")
+        index = {"key": key, "num_images": int(num_images),
+                 "frame_shape": [int(d) for d in self.frame_shape]}
+
+        reuse = False
+        if os.path.exists(index_path) and os.path.exists(frames_path) \
+                and os.path.exists(valid_path):
+            with open(index_path) as f:
+                reuse = json.load(f) == index
+        if reuse:
+            self._frames = np.load(frames_path, mmap_mode="r+")
+            self._valid = np.load(valid_path, mmap_mode="r+")
+        else:
+            self._frames = np.lib.format.open_memmap(
+                frames_path, mode="w+", dtype=np.uint8,
+                shape=(num_images,) + self.frame_shape)
+            self._valid = np.lib.format.open_memmap(
+                valid_path, mode="w+", dtype=np.uint8, shape=(num_images,))
+            with open(index_path, "w") as f:
+                json.dump(index, f)
+
+    def get(self, image_id):
+        """Returns the cached frame of image_id or None. Returned arrays are
+        read-only and shared, copy them before modifying.
+        """
+        with self._lock:
+            image = self._memory.get(image_id)
+            if image is not None:
+                self._memory.move_to_end(image_id)
+                self.memory_hits += 1
+                return image
+        if self._valid is not None and self._valid[image_id]:
+            image = self._frames[image_id].view()
+            image.flags.writeable = False
+            self.disk_hits += 1
+            return image
+        self.misses += 1
+        return None
+
+    def put(self, image_id, image):
+        """Adds a decoded frame to the cache."""
+        image = np.asarray(image, dtype=np.uint8)
+        # On-disk tier. Write the pixels before raising the flag so other
+        # processes never see a partially written slot.
+        if self._valid is not None and image.shape == self.frame_shape \
+                and not self._valid[image_id]:
+            self._frames[image_id] = image
+            self._valid[image_id] = 1
+
+        # In-memory tier
+        if image.nbytes > self.max_bytes:
+            return
+        image = image.copy()
+        image.flags.writeable = False
+        with self._lock:
+            old = self._memory.pop(image_id, None)
+            if old is not None:
+                self._memory_bytes -= old.nbytes
+            self._memory[image_id] = image
+            self._memory_bytes += image.nbytes
+            while self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.nbytes
+
+    def flush(self):
+        """Flushes the on-disk tier to the file."""
+        if self._frames is not None:
+            self._frames.flush()
+            self._valid.flush()
+
+    def stats(self):
+        """Returns the hit/miss counters and tier sizes as a dict."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_frames": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_frames": int(np.count_nonzero(self._valid)) if self._valid is not None else 0,
+        }
+
+
+def image_list_key(image_info):
+    """Returns a short hash identifying the frames referenced by a list of
+    image_info dicts, used to invalidate stale on-disk tiers.
+    """
+    h = hashlib.sha1()
+    for info in image_info:
+        h.update("{}|{}|{}\n".format(info.get("path"), info.get("frame"),
+                                     info.get("side")).encode("utf-8"))
+    return h.hexdigest()
@@ -0,0 +1,119 @@
+"""
+Mask R-CNN
+Dynamic micro-batching for keypoint inference.
+
+The inference graph is compiled for BATCH_SIZE images, but producers such
+as camera readers usually have one frame at a time. The KeypointBatcher
+collects images submitted from any number of threads, waits at most
+max_wait seconds for more to arrive, and runs them through
+MaskRCNN.detect_keypoint() together, so throughput scales with
+IMAGES_PER_GPU instead of staying at one image per call.
+
+Usage:
+    batcher = KeypointBatcher(model, max_wait=0.01)
+    # From any thread
+    result = batcher.detect(image)
+    ...
+    batcher.close()
+"""
+
+import time
+import threading
+import queue
+import logging
+from concurrent.futures import Future
+
+import tensorflow as tf
+
+
+class KeypointBatcher(object):
+    """Runs detect_keypoint() for images submitted from several threads.
+
+    model: MaskRCNN in inference mode.
+    max_wait: Seconds to wait for a batch to fill after its first image.
+    batch_size: Images per call. Defaults to config.BATCH_SIZE.
+    """
+
+    def __init__(self, model, max_wait=0.01, batch_size=None):
+        assert model.mode == "inference", "Create model in inference mode."
+        self.model = model
+        self.max_wait = max_wait
+        self.batch_size = batch_size or model.config.BATCH_SIZE
+        self._requests = queue.Queue()
+        self._closed = False
+
+        # Keras builds the predict function lazily in the calling thread.
+        # Build it here and remember the graph, so the worker thread runs in
+        # the same graph as the model.
+        model.keras_model._make_predict_function()
+        self._graph = tf.get_default_graph()
+
+        # Number of batches and images run, for tuning max_wait
+        self.batches = 0
+        self.images = 0
+
+        self._thread = threading.Thread(target=self._run, name="KeypointBatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, image):
+        """Queues an image. Returns a concurrent.futures.Future of its
+        detect_keypoint() result dict.
+        """
+        assert not self._closed, "KeypointBatcher is closed"
+        future = Future()
+        self._requests.put((image, future))
+        return future
+
+    def detect(self, image):
+        """Runs detection on one image and waits for the result dict."""
+        return self.submit(image).result()
+
+    def close(self):
+        """Finishes the queued images and stops the worker thread."""
+        if not self._closed:
+            self._closed = True
+            self._requests.put(None)
+            self._thread.join()
+
+    def _next_batch(self):
+        """Blocks for the first request, then collects more until the batch
+        is full or max_wait has passed. Returns (batch, stop).
+        """
+        first = self._requests.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        with self._graph.as_default():
+            stop = False
+            while not stop:
+                batch, stop = self._next_batch()
+                if not batch:
+                    continue
+                futures = [future for _, future in batch]
+                try:
+                    results = self.model.detect_keypoint([image for image, _ in batch])
+                except Exception as e:
+                    logging.exception("Error running a batch of {} images".format(len(batch)))
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.images += len(batch)
+                for future, result in zip(futures, results):
+                    future.set_result(result)
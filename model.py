@@ -11,15 +11,19 @@ import os
 import sys
 import glob
 import random
+import time
 import math
 import datetime
 import itertools
 import json
+import hashlib
 import re
 import logging
+import multiprocessing
 from collections import OrderedDict
 import numpy as np
 import scipy.misc
+import cv2
 import tensorflow as tf
 import keras
 import keras.backend as K
@@ -178,6 +182,19 @@ def resnet_graph(input_image, architecture, stage5=False):
     return [C1, C2, C3, C4, C5]
 
 
+# Layers of resnet_graph("resnet101", stage5=True) that output C2-C5, with
+# their depths and strides
+BACKBONE_FEATURE_LAYERS = ["res2c_out", "res3d_out", "res4w_out", "res5c_out"]
+BACKBONE_FEATURE_DEPTHS = [256, 512, 1024, 2048]
+BACKBONE_FEATURE_STRIDES = [4, 8, 16, 32]
+
+
+def backbone_feature_shapes(config):
+    """Returns the [height, width, depth] of C2-C5 for the config's images."""
+    return [(int(config.IMAGE_SHAPE[0]) // stride, int(config.IMAGE_SHAPE[1]) // stride, depth)
+            for stride, depth in zip(BACKBONE_FEATURE_STRIDES, BACKBONE_FEATURE_DEPTHS)]
+
+
 ############################################################
 #  Proposal Layer
 ############################################################
@@ -1663,25 +1680,44 @@ def load_image_gt(dataset, config, image_id, augment=False,
     """
     # Load image and mask
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
+    # Datasets with contour annotations skip the full size masks
+    polygons = dataset.load_mask_polygons(image_id)
+    if polygons is None:
+        mask, class_ids = dataset.load_mask(image_id)
+    else:
+        polygons, class_ids = polygons
     shape = image.shape
     image, window, scale, padding = utils.resize_image(
         image,
         min_dim=config.IMAGE_MIN_DIM,
         max_dim=config.IMAGE_MAX_DIM,
         padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
+    if polygons is None:
+        mask = utils.resize_mask(mask, scale, padding)
+    else:
+        polygons = utils.resize_polygons(polygons, scale, padding)
 
     # Random horizontal flips.
     if augment:
         if random.randint(0, 1):
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            if polygons is None:
+                mask = np.fliplr(mask)
+            else:
+                polygons = utils.flip_polygons(polygons, image.shape[1])
+
+    if polygons is not None:
+        # Boxes from the vertices, masks drawn at their final size
+        bbox = utils.extract_polygon_bboxes(polygons, image.shape)
+        mask = utils.rasterize_polygons(
+            bbox, polygons, image.shape,
+            mini_shape=config.MINI_MASK_SHAPE if use_mini_mask else None)
 
     # Bounding boxes. Note that some boxes might be all zeros
     # if the corresponding mask got cropped out.
     # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+    if polygons is None:
+        bbox = utils.extract_bboxes(mask)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1693,7 +1729,7 @@ def load_image_gt(dataset, config, image_id, augment=False,
     active_class_ids[source_class_ids] = 1
 
     # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
+    if use_mini_mask and polygons is None:
         mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
@@ -1704,7 +1740,7 @@ def load_image_gt(dataset, config, image_id, augment=False,
 
 
 def load_image_gt_keypoints(dataset, config, image_id, augment=True,
-                  use_mini_mask=False):
+                  use_mini_mask=False, load_image=True):
     """Load and return ground truth data for an image (image, keypoint_mask, keypoint_weight, mask, bounding boxes).
 
     augment: If true, apply random image augmentation. Currently, only
@@ -1714,6 +1750,10 @@ def load_image_gt_keypoints(dataset, config, image_id, augment=True,
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    load_image: If False, the image isn't decoded, for callers that only
+        need the targets. The resize geometry comes from
+        dataset.image_shape() and the returned image is a read-only
+        placeholder of the right shape.
 
     Returns:
     image: [height, width, 3]
@@ -1728,19 +1768,44 @@ def load_image_gt_keypoints(dataset, config, image_id, augment=True,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
+    # Pre-molded shards (see shards.py) already hold the outputs of
+    # the resize and mini-mask steps below.
+    if hasattr(dataset, "load_molded"):
+        assert not augment, "Pre-molded datasets don't support augmentation"
+        return dataset.load_molded(image_id, use_mini_mask=use_mini_mask)
+
     # Load image and mask
-    image = dataset.load_image(image_id)
+    if load_image:
+        image = dataset.load_image(image_id)
+        shape = image.shape
+    else:
+        shape = dataset.image_shape(image_id)
     # mask, class_ids = dataset.load_mask(image_id)
-    shape = image.shape
-    keypoints, mask, class_ids = dataset.load_keypoints(image_id)
+    # Keypoint-only datasets give boxes instead of full size masks
+    compact = dataset.load_keypoints_compact(image_id)
+    if compact is None:
+        keypoints, mask, class_ids = dataset.load_keypoints(image_id)
+    else:
+        keypoints, bbox, class_ids = compact
     assert (config.NUM_KEYPOINTS == keypoints.shape[1])
 
-    image, window, scale, padding = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        max_dim=config.IMAGE_MAX_DIM,
-        padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
+    if load_image:
+        image, window, scale, padding = utils.resize_image(
+            image,
+            min_dim=config.IMAGE_MIN_DIM,
+            max_dim=config.IMAGE_MAX_DIM,
+            padding=config.IMAGE_PADDING)
+    else:
+        image_shape, window, scale, padding = utils.resize_image_shape(
+            shape,
+            min_dim=config.IMAGE_MIN_DIM,
+            max_dim=config.IMAGE_MAX_DIM,
+            padding=config.IMAGE_PADDING)
+        image = np.broadcast_to(np.uint8(0), image_shape)
+    if compact is None:
+        mask = utils.resize_mask(mask, scale, padding)
+    else:
+        bbox = utils.resize_boxes(bbox, scale, padding, image.shape)
     keypoints = utils.resize_keypoints(keypoints, image.shape[:2], scale, padding)
 
     # Random horizontal flips.
@@ -1748,7 +1813,10 @@ def load_image_gt_keypoints(dataset, config, image_id, augment=True,
     if augment:
         if random.randint(0, 1):
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            if compact is None:
+                mask = np.fliplr(mask)
+            else:
+                bbox = utils.flip_boxes(bbox, image.shape[1])
             keypoint_names,keypoint_flip_map = utils.get_keypoints()
             keypoints = utils.flip_keypoints(keypoint_names,keypoint_flip_map,keypoints, image.shape[1])
 
@@ -1757,7 +1825,12 @@ def load_image_gt_keypoints(dataset, config, image_id, augment=True,
     # bbox: [num_instances, (y1, x1, y2, x2)]
     # print("mask shape:",np.shape(mask))
     # print("keypoint mask shape:",np.shape(keypoint_mask))
-    bbox = utils.extract_bboxes(mask)
+    if compact is None:
+        bbox = utils.extract_bboxes(mask)
+    else:
+        # Masks fill the boxes, drawn at their final size
+        mask = utils.box_masks(bbox, image.shape,
+                               mini_shape=config.MINI_MASK_SHAPE if use_mini_mask else None)
 
 
     # Active classes
@@ -1770,7 +1843,7 @@ def load_image_gt_keypoints(dataset, config, image_id, augment=True,
     active_class_ids[source_class_ids] = 1
 
     # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
+    if use_mini_mask and compact is None:
         mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
 
@@ -1910,43 +1983,166 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     # Generate class-specific target masks.
     masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
                      dtype=np.float32)
+    if config.USE_MINI_MASK:
+        # Resize the mini masks of all GT boxes to their box size once,
+        # rather than expanding one image sized mask per ROI.
+        gt_crops = utils.expand_mask(gt_boxes, gt_masks, config.IMAGE_SHAPE, crop=True,
+                                     interpolation=utils.NEAREST_INTERPOLATION)
     for i in pos_ids:
         class_id = roi_gt_class_ids[i]
         assert class_id > 0, "class id must be greater than 0"
         gt_id = roi_gt_assignment[i]
-        class_mask = gt_masks[:, :, gt_id]
-
-        if config.USE_MINI_MASK:
-            # Create a mask placeholder, the size of the image
-            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
-            # GT box
-            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
-            gt_w = gt_x2 - gt_x1
-            gt_h = gt_y2 - gt_y1
-            # Resize mini mask to size of GT box
-            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
-                np.round(scipy.misc.imresize(class_mask.astype(float), (gt_h, gt_w),
-                                             interp='nearest') / 255.0).astype(bool)
-            # Place the mini batch in the placeholder
-            class_mask = placeholder
 
         # Pick part of the mask and resize it
         y1, x1, y2, x2 = rois[i].astype(np.int32)
-        m = class_mask[y1:y2, x1:x2]
-        mask = scipy.misc.imresize(
-            m.astype(float), config.MASK_SHAPE, interp='nearest') / 255.0
+        y1, x1 = max(y1, 0), max(x1, 0)
+        y2, x2 = min(y2, config.IMAGE_SHAPE[0]), min(x2, config.IMAGE_SHAPE[1])
+        if config.USE_MINI_MASK:
+            # The part of the GT box crop inside the ROI. The rest is zero.
+            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
+            m = np.zeros([max(y2 - y1, 0), max(x2 - x1, 0)], dtype=np.uint8)
+            oy1, ox1 = max(y1, gt_y1), max(x1, gt_x1)
+            oy2, ox2 = min(y2, gt_y2), min(x2, gt_x2)
+            if oy2 > oy1 and ox2 > ox1:
+                m[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] = \
+                    gt_crops[gt_id][oy1 - gt_y1:oy2 - gt_y1, ox1 - gt_x1:ox2 - gt_x1]
+        else:
+            m = gt_masks[y1:y2, x1:x2, gt_id].astype(np.uint8)
+        mask = cv2.resize(m, (config.MASK_SHAPE[1], config.MASK_SHAPE[0]),
+                          interpolation=utils.NEAREST_INTERPOLATION)
         masks[i, :, :, class_id] = mask
 
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def get_anchors(config):
+    """Returns the utils.AnchorLayout of the pyramid anchors of the config,
+    generated once per process (or loaded from config.ANCHOR_CACHE_DIR).
+    """
+    return utils.get_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                     config.RPN_ANCHOR_RATIOS,
+                                     config.BACKBONE_SHAPES,
+                                     config.BACKBONE_STRIDES,
+                                     config.RPN_ANCHOR_STRIDE,
+                                     cache_dir=config.ANCHOR_CACHE_DIR)
+
+
+def _hash_annotations(sha1, value):
+    """Adds annotations of nested dicts, lists and arrays to a SHA-1."""
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            sha1.update(repr(key).encode())
+            _hash_annotations(sha1, value[key])
+    elif isinstance(value, (list, tuple)):
+        sha1.update("[{}]".format(len(value)).encode())
+        for item in value:
+            _hash_annotations(sha1, item)
+    elif isinstance(value, np.ndarray):
+        sha1.update(repr((value.dtype.str, value.shape)).encode())
+        sha1.update(np.ascontiguousarray(value).tobytes())
+    else:
+        sha1.update(repr(value).encode())
+
+
+def dataset_signature(dataset, config):
+    """SHA-1 of the image list, the image annotations and the config values
+    that decide the outputs of load_image_gt_keypoints(). Keys the instance
+    index and the feature cache of a dataset.
+    """
+    sha1 = hashlib.sha1()
+    for info in dataset.image_info:
+        sha1.update(repr((info.get("source"), info.get("id"), info.get("path"),
+                          info.get("frame"), info.get("side"))).encode())
+        # Edited annotations change which instances are usable
+        _hash_annotations(sha1, info.get("annotations"))
+    sha1.update(repr((config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM, config.IMAGE_PADDING,
+                      config.NUM_KEYPOINTS)).encode())
+    return sha1.hexdigest()
+
+
+def build_instance_index(dataset, config, cache_dir=None):
+    """Scans a dataset once and records which images data_generator_keypoint()
+    would skip, so samplers only draw usable images.
+
+    cache_dir: If given, the index is saved there as
+        instances_<sha1>.npz, keyed by the image list and config, and loaded
+        from there by later calls.
+
+    Returns:
+    instance_counts: [num_images] Number of instances with a class ID > 0
+        of each image of dataset.image_ids.
+    valid: [num_images] bool. True for images with instances and at least
+        one non empty box.
+    """
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, "instances_{}.npz".format(
+            dataset_signature(dataset, config)))
+        if os.path.exists(path):
+            with np.load(path) as index:
+                return index["instance_counts"], index["valid"]
+
+    instance_counts = np.zeros([len(dataset.image_ids)], dtype=np.int32)
+    valid = np.zeros([len(dataset.image_ids)], dtype=bool)
+    for i, image_id in enumerate(dataset.image_ids):
+        try:
+            _, _, gt_class_ids, gt_boxes, _, _ = load_image_gt_keypoints(
+                dataset, config, image_id, augment=False, use_mini_mask=config.USE_MINI_MASK)
+        except Exception:
+            logging.exception("Error processing image {}".format(
+                dataset.image_info[image_id]))
+            continue
+        instance_counts[i] = np.sum(gt_class_ids > 0)
+        # The same checks as data_generator_keypoint()
+        valid[i] = instance_counts[i] > 0 and np.sum(gt_boxes[:, :5]) > 0
+
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file and rename it, so a reader never sees a
+        # partial index.
+        tmp_path = "{}.{}.tmp.npz".format(path[:-4], os.getpid())
+        np.savez(tmp_path, instance_counts=instance_counts, valid=valid)
+        os.replace(tmp_path, path)
+    return instance_counts, valid
+
+
+def usable_image_ids(dataset, config):
+    """Returns the image IDs to train on. With config.INSTANCE_INDEX_DIR set,
+    images without usable instances are left out (see build_instance_index()).
+    Otherwise all images of the dataset.
+    """
+    if not config.INSTANCE_INDEX_DIR:
+        return np.copy(dataset.image_ids)
+    _, valid = build_instance_index(dataset, config, cache_dir=config.INSTANCE_INDEX_DIR)
+    image_ids = np.asarray(dataset.image_ids)[valid]
+    log("{} of {} images have usable instances".format(len(image_ids), len(valid)))
+    return image_ids
+
+
+def match_anchors(anchors, gt_boxes, config, prefilter=True):
+    """Returns anchor_iou_max, anchor_iou_argmax and gt_iou_argmax of the
+    anchors and GT boxes. Uses the sparse grid lookup if
+    config.RPN_SPARSE_OVERLAPS is set, which requires the anchors to be the
+    pyramid anchors of the config.
+    """
+    if config.RPN_SPARSE_OVERLAPS:
+        layout = get_anchors(config)
+        assert layout.anchors.shape == anchors.shape, \
+            "RPN_SPARSE_OVERLAPS needs the pyramid anchors of the config"
+        return utils.sparse_anchor_gt_overlaps(layout, gt_boxes)
+    return utils.anchor_gt_overlaps(anchors, gt_boxes, prefilter)
+
+
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      prefilter=True):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    prefilter: If True, skip IoU computation for anchors that can't overlap
+        any GT box. Doesn't change the results.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
@@ -1968,16 +2164,16 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        # Overlaps with crowd boxes [anchors, crowds]
+        crowd_iou_max = match_anchors(anchors, crowd_boxes, config, prefilter)[0]
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Best matches between anchors and GT boxes
+    anchor_iou_max, anchor_iou_argmax, gt_iou_argmax = \
+        match_anchors(anchors, gt_boxes, config, prefilter)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1989,12 +2185,9 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
@@ -2017,36 +2210,33 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes. Closest gt box (it might have
+    # IoU < 0.7). Computed in float64, unlike utils.box_refinement().
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    a = anchors[ids]
+    gt = gt_boxes[anchor_iou_argmax[ids]]
+
+    # Convert coordinates to center plus width/height.
+    # GT Box
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    # Anchor
+    a_h = a[:, 2] - a[:, 0]
+    a_w = a[:, 3] - a[:, 1]
+    a_center_y = a[:, 0] + 0.5 * a_h
+    a_center_x = a[:, 1] + 0.5 * a_w
+
+    # Compute the bbox refinement that the RPN should predict.
+    rpn_bbox[:ids.shape[0]] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    # Normalize
+    rpn_bbox[:ids.shape[0]] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
@@ -2125,8 +2315,121 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     return rois
 
 
+class BatchBuffers(object):
+    """The input arrays of one batch of data_generator_keypoint(), with a
+    declared dtype per input.
+
+    With config.COMPACT_BATCHES, images stay uint8 (they are molded in the
+    graph), masks are bool and keypoints int16. Otherwise images are molded
+    float32 and masks and keypoints float64, as before.
+
+    The arrays can be refilled for every batch: add() overwrites the images,
+    metas and RPN targets of a sample and zeroes the instance padding.
+
+    feature_shapes: If given, the batch holds cached float16 C2-C5 features
+        of these shapes instead of images. See feature_cache.py
+    """
+
+    def __init__(self, config, batch_size, image_shape, meta_shape, num_anchors,
+                 num_keypoints, feature_shapes=None):
+        self.config = config
+        compact = config.COMPACT_BATCHES
+        mask_shape = tuple(config.MINI_MASK_SHAPE) if config.USE_MINI_MASK \
+            else tuple(image_shape[:2])
+        b, n = batch_size, config.MAX_GT_INSTANCES
+        # name: (shape, dtype) in the order of the model inputs
+        if feature_shapes is not None:
+            self.specs = OrderedDict(
+                (name, ((b,) + tuple(shape), np.float16))
+                for name, shape in zip(["c2", "c3", "c4", "c5"], feature_shapes))
+        else:
+            self.specs = OrderedDict([
+                ("images", ((b,) + tuple(image_shape), np.uint8 if compact else np.float32))])
+        self.specs.update([
+            ("image_meta", ((b,) + tuple(meta_shape), np.int64)),
+            ("rpn_match", ((b, num_anchors, 1), np.int32)),
+            ("rpn_bbox", ((b, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), np.float64)),
+            ("gt_class_ids", ((b, n), np.int32)),
+            ("gt_boxes", ((b, n, 4), np.int32)),
+            ("gt_keypoints", ((b, n, num_keypoints, 3), np.int16 if compact else np.float64)),
+            ("gt_masks", ((b,) + mask_shape + (n,), np.bool_ if compact else np.float64)),
+        ])
+        self.arrays = OrderedDict(
+            (name, np.zeros(shape, dtype=dtype)) for name, (shape, dtype) in self.specs.items())
+
+    def add(self, b, image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes,
+            gt_masks, gt_keypoints, features=None):
+        """Writes a sample to batch item b. features are the cached
+        [C2, C3, C4, C5] of the image if the batch holds features.
+        """
+        a = self.arrays
+        if "images" not in a:
+            for name, feature in zip(["c2", "c3", "c4", "c5"], features):
+                a[name][b] = feature
+        elif self.config.COMPACT_BATCHES:
+            a["images"][b] = image
+        else:
+            a["images"][b] = mold_image(image.astype(np.float32), self.config)
+        a["image_meta"][b] = image_meta
+        a["rpn_match"][b] = rpn_match[:, np.newaxis]
+        a["rpn_bbox"][b] = rpn_bbox
+        n = gt_class_ids.shape[0]
+        a["gt_class_ids"][b, :n] = gt_class_ids
+        a["gt_class_ids"][b, n:] = 0
+        a["gt_boxes"][b, :n] = gt_boxes
+        a["gt_boxes"][b, n:] = 0
+        a["gt_masks"][b, :, :, :n] = gt_masks
+        a["gt_masks"][b, :, :, n:] = 0
+        a["gt_keypoints"][b, :n] = gt_keypoints
+        a["gt_keypoints"][b, n:] = 0
+
+    def inputs(self):
+        """Returns the arrays in the order of the model inputs."""
+        return list(self.arrays.values())
+
+
+def choose_loader_size(produce_seconds, consume_seconds, batch_bytes, memory_budget,
+                       max_workers=None, max_queue_size=100):
+    """Picks the number of data loader workers and the generator queue size.
+
+    produce_seconds: Time one worker takes to build a batch.
+    consume_seconds: Time a training step takes.
+    batch_bytes: Size of the arrays of one batch.
+    memory_budget: Bytes the queued batches and the batches in flight in
+        the workers may use.
+    max_workers: Defaults to the number of CPUs minus one.
+
+    Enough workers are used to build batches 20% faster than training
+    consumes them. Each worker holds about two batches (one it builds, one
+    it sends), and the queue holds two batches per worker to absorb jitter,
+    as far as the memory budget allows.
+
+    Returns (workers, max_queue_size, reason) where reason explains the
+    choice for the log.
+    """
+    max_workers = max_workers or max(multiprocessing.cpu_count() - 1, 1)
+    needed = int(math.ceil(1.2 * produce_seconds / max(consume_seconds, 1e-6)))
+    workers = int(np.clip(needed, 1, max_workers))
+    batch_bytes = max(batch_bytes, 1)
+    # Fewer workers if their batches and a queue of 2 don't fit the budget
+    while workers > 1 and (2 * workers + 2) * batch_bytes > memory_budget:
+        workers -= 1
+    fits = int((memory_budget - 2 * workers * batch_bytes) // batch_bytes)
+    queue_size = int(np.clip(min(2 * workers, fits), 1, max_queue_size))
+
+    megabytes = batch_bytes / float(1 << 20)
+    reason = ("Batches take {:.0f} ms to build and {:.0f} ms to train on, so {} "
+              "worker(s) are needed to keep up{}. A batch is {:.1f} MB, so the queue and "
+              "workers use about {:.0f} MB of the {:.0f} MB budget.").format(
+        produce_seconds * 1000, consume_seconds * 1000, needed,
+        "" if workers == needed else " ({} fit the CPUs and memory budget)".format(workers),
+        megabytes, (queue_size + 2 * workers) * megabytes, memory_budget / float(1 << 20))
+    return workers, queue_size, reason
+
+
 def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_rois=0,
-                   batch_size=1, detection_targets=False):
+                   batch_size=1, detection_targets=False, image_ids=None,
+                   reuse_buffers=False, feature_store=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, keypoint_masks, keypoint_weights, masks.
 
@@ -2142,12 +2445,23 @@ def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_
     detection_targets: If True, generate detection targets (class IDs, bbox
         deltas, and masks). Typically for debugging or visualizations because
         in trainig detection targets are generated by DetectionTargetLayer.
+    image_ids: The images to sample from. Defaults to all images of the
+        dataset. See usable_image_ids().
+    reuse_buffers: If True, every batch is written into the same arrays.
+        Only safe when the consumer is done with (or has copied) a batch
+        before it asks for the next one, as SharedBatchLoader does.
+    feature_store: A feature_cache.FeatureStore of the dataset. If given,
+        batches hold the cached C2-C5 features of the images instead of the
+        images, for a model built with config.FEATURE_CACHE_DIR. The
+        features are of the unaugmented images, so augment must be False.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The containtes
     of the lists differs depending on the received arguments:
     inputs list:
-    - images: [batch, H, W, C]
+    - images: [batch, H, W, C]. uint8 and not molded yet if
+        config.COMPACT_BATCHES is set. With a feature_store, four float16
+        arrays of C2-C5 features instead.
     - image_meta: [batch, size of image meta]
     - rpn_match: [batch, N] Integer (1=positive anchor, -1=negative, 0=neutral)
     - rpn_bbox: [batch, N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
@@ -2166,18 +2480,17 @@ def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_
         is True then the outputs list contains target class_ids, bbox deltas,
         and masks.
     """
+    assert feature_store is None or not augment, "Cached features are of unaugmented images"
     b = 0  # batch item index
     image_index = -1
-    image_ids = np.copy(dataset.image_ids)
+    image_ids = np.copy(dataset.image_ids if image_ids is None else image_ids)
     error_count = 0
+    buffers = None
+    feature_shapes = feature_store.shapes if feature_store is not None else None
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             config.BACKBONE_SHAPES,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors = get_anchors(config).anchors
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -2190,8 +2503,11 @@ def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_
             # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
             #image_meta:image_id,image_shape,windows.active_class_ids
+            # With cached features only the targets are needed
             image, image_meta, gt_class_ids, gt_boxes, gt_masks, gt_keypoints = \
-                load_image_gt_keypoints(dataset, config, image_id, augment, use_mini_mask=config.USE_MINI_MASK)
+                load_image_gt_keypoints(dataset, config, image_id, augment,
+                                        use_mini_mask=config.USE_MINI_MASK,
+                                        load_image=feature_store is None)
 
             Num_keypoint = np.shape(gt_keypoints)[1]
 
@@ -2220,28 +2536,9 @@ def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_
 
             # Init batch arrays
             if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-
-                batch_gt_keypoints = np.zeros((batch_size, config.MAX_GT_INSTANCES, Num_keypoint,3))
-
-                if config.USE_MINI_MASK:
-                    batch_gt_masks = np.zeros((batch_size, config.MINI_MASK_SHAPE[0], config.MINI_MASK_SHAPE[1],
-                                               config.MAX_GT_INSTANCES))
-
-                else:
-                    batch_gt_masks = np.zeros(
-                        (batch_size, image.shape[0], image.shape[1], config.MAX_GT_INSTANCES))
+                if buffers is None or not reuse_buffers:
+                    buffers = BatchBuffers(config, batch_size, image.shape, image_meta.shape,
+                                           anchors.shape[0], Num_keypoint, feature_shapes)
 
                 #Not implemented for keypoint mask and no need here
                 if random_rois:
@@ -2268,14 +2565,9 @@ def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_
 
 
             # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
-            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
-            batch_gt_keypoints[b, :gt_keypoints.shape[0], :,:] = gt_keypoints
+            features = feature_store.features(image_id) if feature_store is not None else None
+            buffers.add(b, image, image_meta, rpn_match, rpn_bbox, gt_class_ids,
+                        gt_boxes, gt_masks, gt_keypoints, features)
             #Not implemented for keypoint_mask and no need here.
             if random_rois:
                 batch_rpn_rois[b] = rpn_rois
@@ -2291,8 +2583,7 @@ def data_generator_keypoint(dataset, config, shuffle=True, augment=True, random_
             #  input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_keypoint_masks,
             #  input_gt_keypoint_weigths
             if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_keypoints,batch_gt_masks]
+                inputs = buffers.inputs()
                 outputs = []
                 # Not implemented for keypoint_mask and no need here.
                 if random_rois:
@@ -2362,11 +2653,7 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             config.BACKBONE_SHAPES,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors = get_anchors(config).anchors
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -2492,6 +2779,132 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
                 raise
 
 
+class KeypointSequence(keras.utils.Sequence):
+    """Index-addressable version of data_generator_keypoint() for Keras'
+    OrderedEnqueuer.
+
+    Batch i of an epoch holds images permutation[i * batch_size:...] of a
+    permutation computed from (seed, epoch), so all worker processes agree
+    on it and an epoch visits every image once. Before building a batch the
+    global numpy and Python RNGs are seeded from (seed, epoch, index), which
+    makes augmentation and RPN target sampling reproducible no matter which
+    worker builds the batch.
+
+    Pass only images with usable instances (see usable_image_ids()), so
+    batches don't skip images. An image that can't be used is replaced by a
+    random image drawn with the batch RNG, so such an epoch isn't a strict
+    single pass.
+
+    dataset: The Dataset object to pick data from
+    config: The model config object
+    shuffle: If True, uses a new permutation every epoch
+    augment: If True, applies image augmentation to images
+    batch_size: How many images to return in each batch
+    seed: Base seed of the permutations and batch RNGs
+    image_ids: The images to sample from. Defaults to all images of the
+        dataset. See usable_image_ids().
+    feature_store: A feature_cache.FeatureStore of the dataset, to return
+        cached features instead of images. See data_generator_keypoint().
+
+    Batches are the (inputs, outputs) of data_generator_keypoint() without
+    random_rois or detection_targets.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augment=False, batch_size=1,
+                 seed=None, image_ids=None, feature_store=None):
+        assert feature_store is None or not augment, "Cached features are of unaugmented images"
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augment = augment
+        self.batch_size = batch_size
+        self.seed = seed if seed is not None else random.randint(0, 2 ** 31 - 1)
+        self.image_ids = np.copy(dataset.image_ids if image_ids is None else image_ids)
+        self.feature_store = feature_store
+        self.epoch = 0
+        self._permutation_epoch = None
+        self._permutation = None
+        assert len(self.image_ids) >= batch_size, "Fewer images than batch_size"
+
+    def __len__(self):
+        return len(self.image_ids) // self.batch_size
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def permutation(self):
+        """Returns the image IDs in the order of the current epoch."""
+        if self._permutation_epoch != self.epoch:
+            if self.shuffle:
+                rng = np.random.RandomState((self.seed + self.epoch) % (2 ** 32))
+                self._permutation = rng.permutation(self.image_ids)
+            else:
+                self._permutation = self.image_ids
+            self._permutation_epoch = self.epoch
+        return self._permutation
+
+    def batch_seed(self, index):
+        """Seed of the RNGs of batch index in the current epoch."""
+        return (self.seed * 1000003 + self.epoch * 7919 + index) % (2 ** 32)
+
+    def __getitem__(self, index):
+        config = self.config
+        seed = self.batch_seed(index)
+        np.random.seed(seed)
+        random.seed(seed)
+        anchors = get_anchors(config).anchors
+
+        # Images of this batch. An image that can't be used is replaced by a
+        # random one, not by images of later batches.
+        permutation = self.permutation()
+        candidates = list(permutation[index * self.batch_size:(index + 1) * self.batch_size])
+        samples = []
+        error_count = 0
+        while candidates:
+            image_id = candidates.pop(0)
+            try:
+                image, image_meta, gt_class_ids, gt_boxes, gt_masks, gt_keypoints = \
+                    load_image_gt_keypoints(self.dataset, config, image_id, self.augment,
+                                            use_mini_mask=config.USE_MINI_MASK,
+                                            load_image=self.feature_store is None)
+                if not np.any(gt_class_ids > 0) or np.sum(gt_boxes[:, :5]) <= 0:
+                    raise ValueError("Image has no usable instances")
+                rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
+                                                        gt_class_ids, gt_boxes, config)
+            except Exception:
+                logging.exception("Error processing image {}".format(
+                    self.dataset.image_info[image_id]))
+                error_count += 1
+                if error_count > 5:
+                    raise
+                candidates.append(np.random.choice(self.image_ids))
+                continue
+
+            # If more instances than fits in the array, sub-sample from them.
+            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+                ids = np.random.choice(
+                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+                gt_class_ids = gt_class_ids[ids]
+                gt_boxes = gt_boxes[ids]
+                gt_masks = gt_masks[:, :, ids]
+                gt_keypoints = gt_keypoints[ids, :]
+            features = self.feature_store.features(image_id) \
+                if self.feature_store is not None else None
+            samples.append((image, image_meta, rpn_match, rpn_bbox, gt_class_ids,
+                            gt_boxes, gt_masks, gt_keypoints, features))
+        assert len(samples) == self.batch_size, "Not enough usable images for a batch"
+
+        # Pack the batch, with the dtypes of data_generator_keypoint()
+        image, image_meta = samples[0][0], samples[0][1]
+        buffers = BatchBuffers(config, self.batch_size, image.shape, image_meta.shape,
+                               anchors.shape[0], samples[0][7].shape[1],
+                               self.feature_store.shapes if self.feature_store is not None else None)
+        for i, sample in enumerate(samples):
+            buffers.add(i, *sample)
+        inputs = buffers.inputs()
+        return inputs, []
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -2531,8 +2944,24 @@ class MaskRCNN():
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
 
         # Inputs
-        input_image = KL.Input(
-            shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+        if mode == "training" and config.FEATURE_CACHE_DIR:
+            # Heads-only training starts from cached C2-C5 features instead
+            # of images. See feature_cache.py
+            input_image = None
+            input_features = [
+                KL.Input(shape=list(shape), name="input_" + name, dtype=tf.float16)
+                for name, shape in zip(["c2", "c3", "c4", "c5"], backbone_feature_shapes(config))]
+        elif mode == "training" and config.COMPACT_BATCHES:
+            # Batches hold uint8 images. Mold them here instead of on the CPU.
+            input_image = KL.Input(
+                shape=config.IMAGE_SHAPE.tolist(), name="input_image", dtype=tf.uint8)
+            mean_pixel = np.array(config.MEAN_PIXEL, dtype=np.float32)
+            molded_image = KL.Lambda(lambda x: tf.cast(x, tf.float32) - mean_pixel,
+                                     name="mold_image")(input_image)
+        else:
+            input_image = KL.Input(
+                shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+            molded_image = input_image
         input_image_meta = KL.Input(shape=[None], name="input_image_meta")
         if mode == "training":
             # RPN GT
@@ -2550,13 +2979,18 @@ class MaskRCNN():
             input_gt_boxes = KL.Input(
                 shape=[None, 4], name="input_gt_boxes", dtype=tf.float32)
             # Normalize coordinates
-            h, w = K.shape(input_image)[1], K.shape(input_image)[2]
+            if input_image is None:
+                h, w = int(config.IMAGE_SHAPE[0]), int(config.IMAGE_SHAPE[1])
+            else:
+                h, w = K.shape(input_image)[1], K.shape(input_image)[2]
             image_scale = K.cast(K.stack([h, w, h, w], axis=0), tf.float32)
             gt_boxes = KL.Lambda(lambda x: x / image_scale,name="gt_boxes")(input_gt_boxes)
 
             keypoint_scale = K.cast(K.stack([w, h, 1], axis=0), tf.float32)
-            input_gt_keypoints = KL.Input(shape=[None, config.NUM_KEYPOINTS, 3])
-            gt_keypoints = KL.Lambda(lambda x: x / keypoint_scale, name="gt_keypoints")(input_gt_keypoints)
+            input_gt_keypoints = KL.Input(shape=[None, config.NUM_KEYPOINTS, 3],
+                                          dtype=tf.int16 if config.COMPACT_BATCHES else tf.float32)
+            gt_keypoints = KL.Lambda(lambda x: tf.cast(x, tf.float32) / keypoint_scale,
+                                     name="gt_keypoints")(input_gt_keypoints)
             # 3. GT Masks (zero padded)
             # [batch, height, width, MAX_GT_INSTANCES]
             if config.USE_MINI_MASK:
@@ -2585,7 +3019,12 @@ class MaskRCNN():
         # Bottom-up Layers
         # Returns a list of the last layers of each stage, 5 in total.
         # Don't create the thead (stage 5), so we pick the 4th item in the list.
-        _, C2, C3, C4, C5 = resnet_graph(input_image, "resnet101", stage5=True)
+        if input_image is None:
+            C2, C3, C4, C5 = [
+                KL.Lambda(lambda x: tf.cast(x, tf.float32), name="cached_" + name)(x)
+                for name, x in zip(["c2", "c3", "c4", "c5"], input_features)]
+        else:
+            _, C2, C3, C4, C5 = resnet_graph(molded_image, "resnet101", stage5=True)
         # Top-down Layers
         # TODO: add assert to varify feature map sizes match what's in config
         P5 = KL.Conv2D(256, (1, 1), name='fpn_c5p5')(C5)
@@ -2612,11 +3051,7 @@ class MaskRCNN():
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
         # Generate Anchors
-        self.anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                                      config.RPN_ANCHOR_RATIOS,
-                                                      config.BACKBONE_SHAPES,
-                                                      config.BACKBONE_STRIDES,
-                                                      config.RPN_ANCHOR_STRIDE)
+        self.anchors = get_anchors(config).anchors
 
         # RPN Model
         rpn = build_rpn_model(config.RPN_ANCHOR_STRIDE,
@@ -2728,7 +3163,8 @@ class MaskRCNN():
             # Model generated
             # batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox, batch_gt_class_ids, \
             # batch_gt_boxes, batch_gt_keypoint, batch_gt_masks
-            inputs = [input_image, input_image_meta,
+            inputs = [input_image] if input_image is not None else list(input_features)
+            inputs += [input_image_meta,
                       input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_keypoints, input_gt_masks]
             if not config.USE_RPN_ROIS:
                 inputs.append(input_rois)
@@ -2875,6 +3311,7 @@ class MaskRCNN():
         self.keras_model._per_input_losses = {}
         loss_names = ["rpn_class_loss", "rpn_bbox_loss",
                       "mrcnn_class_loss", "mrcnn_bbox_loss", "keypoint_mrcnn_mask_loss", "mrcnn_mask_loss"]
+        self.loss_names = loss_names
         for name in loss_names:
             layer = self.keras_model.get_layer(name)
             if layer.output in self.keras_model.losses:
@@ -3006,13 +3443,34 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
+        # Cached backbone features. See feature_cache.py
+        train_store = val_store = None
+        if self.config.FEATURE_CACHE_DIR:
+            assert layers == layer_regex["heads"], \
+                "A model built with FEATURE_CACHE_DIR has no backbone. Train 'heads' only."
+            import feature_cache
+            train_store = feature_cache.open_store(self.config.FEATURE_CACHE_DIR,
+                                                   train_dataset, self.config)
+            val_store = feature_cache.open_store(self.config.FEATURE_CACHE_DIR,
+                                                 val_dataset, self.config)
+            if self.config.DATA_LOADER == "keras":
+                log("Warning: the 'keras' DATA_LOADER pickles the features of every "
+                    "batch. 'shared_memory' passes them without copies.")
+
         # Data keypoint generators
+        train_ids = usable_image_ids(train_dataset, self.config)
+        val_ids = usable_image_ids(val_dataset, self.config)
 
         train_generator = data_generator_keypoint(train_dataset, self.config, shuffle=True,
-                                        batch_size=self.config.BATCH_SIZE,augment =False)
+                                        batch_size=self.config.BATCH_SIZE,augment =False,
+                                        image_ids=train_ids, feature_store=train_store)
         val_generator = data_generator_keypoint(val_dataset, self.config, shuffle=True,
                                        batch_size=self.config.BATCH_SIZE,
-                                       augment=False)
+                                       augment=False, image_ids=val_ids,
+                                       feature_store=val_store)
+        # One pass over the training images unless the config sets a number
+        steps_per_epoch = self.config.STEPS_PER_EPOCH or \
+            max(len(train_ids) // self.config.BATCH_SIZE, 1)
 
         # Callbacks
         callbacks = [
@@ -3036,20 +3494,109 @@ class MaskRCNN():
         else:
             workers = max(self.config.BATCH_SIZE // 2, 2)
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=next(val_generator),
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-        )
+        validation_data = next(val_generator)
+        use_multiprocessing = True
+        max_queue_size = 100
+        num_slots = None
+        if self.config.LOADER_AUTOTUNE and workers > 0:
+            workers, max_queue_size = self.tune_loader(train_dataset, train_ids, validation_data,
+                                                       feature_store=train_store)
+            num_slots = workers + max_queue_size
+        shared_loader = None
+        if self.config.DATA_LOADER == "sequence":
+            # Workers build batches by index, so they never duplicate work
+            train_generator = KeypointSequence(train_dataset, self.config, shuffle=True,
+                                               batch_size=self.config.BATCH_SIZE,
+                                               augment=False, image_ids=train_ids,
+                                               feature_store=train_store)
+        elif self.config.DATA_LOADER == "shared_memory" and workers > 0:
+            # Our own worker processes fill shared-memory slots. Keras reads
+            # them in the training thread, so it needs no workers of its own.
+            import shared_loader as shared_loader_lib
+            shared_loader = shared_loader_lib.SharedBatchLoader(
+                lambda: data_generator_keypoint(train_dataset, self.config, shuffle=True,
+                                                batch_size=self.config.BATCH_SIZE,
+                                                augment=False, image_ids=train_ids,
+                                                reuse_buffers=True, feature_store=train_store),
+                num_workers=workers, num_slots=num_slots)
+            train_generator = shared_loader
+            max_queue_size = shared_loader.num_slots
+            workers = 0
+            use_multiprocessing = False
+
+        if self.config.STEP_TIMELINE:
+            # Data wait vs. step time of every step. See step_timeline.py
+            import step_timeline
+            callbacks.append(step_timeline.StepTimeline(
+                self.log_dir, max_queue_size=max_queue_size, loss_names=self.loss_names,
+                queue_depth_fn=shared_loader.qsize if shared_loader is not None else None,
+                initial_step=self.epoch * steps_per_epoch))
+
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=steps_per_epoch,
+                callbacks=callbacks,
+                validation_data=validation_data,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=max_queue_size,
+                workers=workers,
+                use_multiprocessing=use_multiprocessing,
+            )
+        finally:
+            if shared_loader is not None:
+                shared_loader.close()
         self.epoch = max(self.epoch, epochs)
 
+    def tune_loader(self, train_dataset, image_ids, training_batch, probe_batches=3,
+                    feature_store=None):
+        """Times how long the data generator takes to build a training batch
+        and how long a training step takes, and picks the number of loader
+        workers and the queue size from them. See choose_loader_size().
+
+        train_dataset, image_ids: The images train() samples from.
+        training_batch: An (inputs, outputs) batch to time training steps on.
+            Afterwards the weights are restored and the optimizer state is
+            reset to that of a new optimizer.
+        probe_batches: Number of batches to time, after one warm-up batch.
+        feature_store: The feature store train() reads, if any.
+
+        Returns (workers, max_queue_size).
+        """
+        generator = data_generator_keypoint(train_dataset, self.config, shuffle=True,
+                                            batch_size=self.config.BATCH_SIZE,
+                                            augment=False, image_ids=image_ids,
+                                            feature_store=feature_store)
+        inputs, _ = next(generator)
+        batch_bytes = sum(a.nbytes for a in inputs)
+        start = time.time()
+        for _ in range(probe_batches):
+            next(generator)
+        produce = (time.time() - start) / probe_batches
+
+        # Training steps change the weights. Put them back afterwards.
+        weights = self.keras_model.get_weights()
+        inputs, outputs = training_batch
+        self.keras_model.train_on_batch(inputs, outputs)
+        start = time.time()
+        for _ in range(probe_batches):
+            self.keras_model.train_on_batch(inputs, outputs)
+        consume = (time.time() - start) / probe_batches
+        self.keras_model.set_weights(weights)
+        # The optimizer creates its iteration count and momentum variables in
+        # the first step, so there was no state to save before it. Zero them,
+        # which is how a new optimizer starts.
+        for w in self.keras_model.optimizer.weights:
+            K.set_value(w, np.zeros(K.int_shape(w), dtype=K.dtype(w)))
+
+        workers, max_queue_size, reason = choose_loader_size(
+            produce, consume, batch_bytes, self.config.LOADER_MEMORY_BUDGET_MB << 20)
+        log("Data loader: {} workers, queue of {} batches. {}".format(
+            workers, max_queue_size, reason))
+        return workers, max_queue_size
+
     def mold_inputs(self, images):
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
@@ -3149,7 +3696,8 @@ class MaskRCNN():
 
         return boxes, class_ids, scores, full_masks
 
-    def unmold_keypoint_detections(self, detections, mrcnn_keypoints, image_shape, window, mrcnn_mask, keypoint_threshold = 0.05):
+    def unmold_keypoint_detections(self, detections, mrcnn_keypoints, image_shape, window, mrcnn_mask, keypoint_threshold = 0.05,
+                                   mask_mode="full"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -3159,14 +3707,25 @@ class MaskRCNN():
         image_shape: [height, width, depth] Original size of the image before resizing
         window: [y1, x1, y2, x2] Box in the image where the real image is
                 excluding the padding.
+        mask_mode: "full" returns image sized masks, "box" returns each mask
+                cropped to its box and "none" skips the masks.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, N] Instance masks
-        keypoints:[N, num_keypoints]
+        keypoints: [N, num_keypoints, (x, y, v)] decoded with
+                config.KEYPOINT_DECODE_METHOD. Integers for "argmax",
+                floats otherwise. v is 1 if the score is above
+                keypoint_threshold.
+        keypoint_scores: [N, num_keypoints] Peak probability of each keypoint
+        masks: "full": [height, width, N] Instance masks
+               "box": List of N [y2 - y1, x2 - x1] masks. Mask i starts at
+                      (y1, x1) of boxes[i].
+               "none": None
         """
+        assert mask_mode in ["full", "box", "none"], \
+            "Unknown mask_mode {}".format(mask_mode)
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
         zero_ix = np.where(detections[:, 4] == 0)[0]
@@ -3176,7 +3735,7 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        masks = mrcnn_mask[np.arange(N), :, :, class_ids] if mask_mode != "none" else None
         mrcnn_keypoints = mrcnn_keypoints[:N, :, :]
 
         # Compute scale and shift to translate coordinates to image domain.
@@ -3202,26 +3761,32 @@ class MaskRCNN():
             class_ids = np.delete(class_ids, exclude_ix, axis=0)
             scores = np.delete(scores, exclude_ix, axis=0)
             mrcnn_keypoints = np.delete(mrcnn_keypoints, exclude_ix, axis=0)
-            masks = np.delete(masks, exclude_ix, axis=0)
+            if masks is not None:
+                masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
-        # Resize masks to original image size and set boundary threshold.
-
-        keypoints = []
+        # Decode all keypoint heatmaps at once
+        keypoints, keypoint_scores = utils.decode_keypoint_heatmaps(
+            mrcnn_keypoints, boxes, self.config.KEYPOINT_MASK_SHAPE,
+            method=self.config.KEYPOINT_DECODE_METHOD)
+        keypoints = np.concatenate(
+            [keypoints, (keypoint_scores > keypoint_threshold)[..., None].astype(keypoints.dtype)],
+            axis=2)
+
+        # Resize masks to box or original image size and set boundary threshold.
+        if mask_mode == "none":
+            return boxes, class_ids, scores, keypoints, keypoint_scores, None
+        if mask_mode == "box":
+            box_masks = [utils.unmold_box_mask(masks[i], boxes[i]) for i in range(N)]
+            return boxes, class_ids, scores, keypoints, keypoint_scores, box_masks
         full_masks = []
         for i in range(N):
             # Convert neural network mask to full size mask
-            keypoint, full_mask = utils.unmold_keypoint_mask(mrcnn_keypoints[i], boxes[i], image_shape,masks[i],keypoint_threshold=keypoint_threshold)
-
-            keypoints.append(keypoint)
-            full_masks.append(full_mask)
-
-        keypoints = np.stack(keypoints,axis=0) if keypoints else np.empty((0,) + (mrcnn_keypoints.shape[1], 3))
+            full_masks.append(utils.unmold_mask(masks[i], boxes[i], image_shape))
         full_masks = np.stack(full_masks, axis=-1) \
             if full_masks else np.empty((0,) + masks.shape[1:3])
 
-
-        return boxes, class_ids, scores, keypoints, full_masks
+        return boxes, class_ids, scores, keypoints, keypoint_scores, full_masks
 
     def detect(self, images, verbose=0):
         """Runs the detection pipeline.
@@ -3266,27 +3831,52 @@ class MaskRCNN():
             })
         return results
 
-    def detect_keypoint(self, images, verbose=0):
+    def detect_keypoint(self, images, verbose=0, mask_mode="full"):
         """Runs the detection pipeline.
 
-        images: List of images, potentially of different sizes.
+        images: List of images, potentially of different sizes. Any number
+            of images is accepted. They are run in batches of BATCH_SIZE and
+            the last batch is padded.
+        mask_mode: Which masks to return. "full" for image sized masks, "box"
+            for masks cropped to their boxes, "none" for keypoints only,
+            which skips all mask work.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [batch, N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [batch, N] int class IDs
         scores: [batch, N] float probability scores for the class IDs
         keypoints: [batch, N, num_keypoints, 3] (x, y, v), keypoint x, y coordinate and valid
+        keypoint_scores: [N, num_keypoints] confidence of each keypoint
+        masks: "full": [H, W, N] instance masks
+               "box": List of N masks of their box size
+               "none": None
+        mask_offsets: Only with "box". [N, (y, x)] image position of the top
+            left corner of each mask.
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(
-            images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
 
         if verbose:
             log("Processing {} images".format(len(images)))
             for image in images:
                 log("image", image)
+        results = []
+        for start in range(0, len(images), self.config.BATCH_SIZE):
+            batch = list(images[start:start + self.config.BATCH_SIZE])
+            results.extend(self._detect_keypoint_batch(batch, verbose, mask_mode))
+        return results
+
+    def _detect_keypoint_batch(self, images, verbose=0, mask_mode="full"):
+        """Runs detect_keypoint() on at most BATCH_SIZE images."""
         # Mold inputs to format expected by the neural network
         molded_images, image_metas, windows = self.mold_inputs(images)
+        # The graph has a fixed batch size. Fill a partial batch with copies
+        # of the last image and drop their outputs below.
+        padding = self.config.BATCH_SIZE - len(images)
+        if padding:
+            molded_images = np.concatenate(
+                [molded_images, np.repeat(molded_images[-1:], padding, axis=0)])
+            image_metas = np.concatenate(
+                [image_metas, np.repeat(image_metas[-1:], padding, axis=0)])
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
@@ -3312,17 +3902,32 @@ class MaskRCNN():
         # Process detections
         results = []
         for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_keypoints,final_masks=\
-                self.unmold_keypoint_detections(detections[i], mrcnn_keypoint_prob[i],
-                                       image.shape, windows[i],mrcnn_mask[i],keypoint_threshold = self.config.KEYPOINT_THRESHOLD)
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "keypoints": final_keypoints,
-                "masks": final_masks
-            })
+            results.append(self.keypoint_result(detections[i], mrcnn_keypoint_prob[i],
+                                                image.shape, windows[i], mrcnn_mask[i],
+                                                mask_mode))
         return results
+
+    def keypoint_result(self, detections, mrcnn_keypoint_prob, image_shape, window, mrcnn_mask,
+                        mask_mode="full"):
+        """Unmolds the network outputs of one image into the result dict of
+        detect_keypoint().
+        """
+        final_rois, final_class_ids, final_scores, final_keypoints, final_keypoint_scores, final_masks=\
+            self.unmold_keypoint_detections(detections, mrcnn_keypoint_prob,
+                                   image_shape, window,mrcnn_mask,keypoint_threshold = self.config.KEYPOINT_THRESHOLD,
+                                   mask_mode=mask_mode)
+        result = {
+            "rois": final_rois,
+            "class_ids": final_class_ids,
+            "scores": final_scores,
+            "keypoints": final_keypoints,
+            "keypoint_scores": final_keypoint_scores,
+            "masks": final_masks
+        }
+        if mask_mode == "box":
+            result["mask_offsets"] = final_rois[:, :2].copy()
+        return result
+
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
         tensor: TensorFlow symbolic tensor.
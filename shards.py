@@ -0,0 +1,216 @@
+"""
+Mask R-CNN
+Pre-molded training shards.
+
+With augment=False, load_image_gt_keypoints() returns the same resized
+image, boxes, mini-masks and keypoints every time it visits an image, yet
+redoes resize_image(), resize_mask(), resize_keypoints(), extract_bboxes()
+and minimize_mask() on every visit. write_shards() runs those steps once
+and stores the results in a compact sharded format:
+
+    <output_dir>/manifest.json         Config, classes and shard list
+    <output_dir>/shard_00000/
+        images.npy           [n, H, W, 3] uint8 resized and padded images
+        image_meta.npy       [n, meta length] as built by compose_image_meta()
+        image_ids.npy        [n] image IDs in the source dataset
+        instance_offsets.npy [n + 1] int64. Instances of image i are rows
+                             instance_offsets[i]:instance_offsets[i + 1]
+        class_ids.npy        [instances] int32
+        boxes.npy            [instances, (y1, x1, y2, x2)] int32
+        keypoints.npy        [instances, NUM_KEYPOINTS, (x, y, v)] int32
+        masks.npy            [instances, ceil(h * w / 8)] uint8 bit-packed masks
+
+ShardDataset serves these records from memory-mapped files without copying
+them, so the generator workers only build RPN targets and batches.
+
+Usage:
+    shards.write_shards(dataset_train, config, "/scratch/cars_shards")
+
+    dataset = shards.ShardDataset()
+    dataset.load_shards("/scratch/cars_shards", config)
+    dataset.prepare()
+"""
+
+import os
+import json
+import logging
+import numpy as np
+
+import utils
+
+# Config attributes that change the stored outputs. A shard set can only be
+# read with a config that agrees on all of them.
+SHARD_CONFIG_KEYS = ["IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_PADDING",
+                     "USE_MINI_MASK", "MINI_MASK_SHAPE", "NUM_KEYPOINTS"]
+
+
+def _config_values(config):
+    values = {}
+    for key in SHARD_CONFIG_KEYS:
+        value = getattr(config, key)
+        values[key] = list(value) if isinstance(value, (tuple, list)) else value
+    return values
+
+
+############################################################
+#  Writer
+############################################################
+
+def write_shards(dataset, config, output_dir, images_per_shard=1000, verbose=1):
+    """Runs load_image_gt_keypoints() with augment=False over every image of
+    a prepared dataset and writes the results as shards in output_dir.
+
+    Images that fail to load are logged and skipped.
+    Returns the number of images written.
+    """
+    import model as modellib
+
+    os.makedirs(output_dir, exist_ok=True)
+    image_ids = dataset.image_ids
+    image_shape = tuple(int(d) for d in config.IMAGE_SHAPE)
+    shards = []
+    written = 0
+
+    for start in range(0, len(image_ids), images_per_shard):
+        shard_ids = image_ids[start:start + images_per_shard]
+        shard_name = "shard_{:05d}".format(len(shards))
+        shard_dir = os.path.join(output_dir, shard_name)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        # Images are written straight into the memory-mapped file. Skipped
+        # images leave unused slots at the end.
+        images = np.lib.format.open_memmap(
+            os.path.join(shard_dir, "images.npy"), mode="w+", dtype=np.uint8,
+            shape=(len(shard_ids),) + image_shape)
+        metas, source_ids, offsets = [], [], [0]
+        class_ids, boxes, keypoints, masks = [], [], [], []
+        mask_shape = None
+
+        for image_id in shard_ids:
+            try:
+                image, image_meta, gt_class_ids, gt_boxes, gt_masks, gt_keypoints = \
+                    modellib.load_image_gt_keypoints(dataset, config, image_id,
+                                                     augment=False,
+                                                     use_mini_mask=config.USE_MINI_MASK)
+            except Exception:
+                logging.exception("Error processing image {}".format(
+                    dataset.image_info[image_id]))
+                continue
+            assert image.shape == image_shape, \
+                "Images must be padded to IMAGE_SHAPE, got {}".format(image.shape)
+            mask_shape = gt_masks.shape[:2]
+
+            i = len(metas)
+            images[i] = image
+            metas.append(image_meta)
+            source_ids.append(image_id)
+            offsets.append(offsets[-1] + gt_class_ids.shape[0])
+            class_ids.append(gt_class_ids.astype(np.int32))
+            boxes.append(gt_boxes.astype(np.int32))
+            keypoints.append(gt_keypoints.astype(np.int32))
+            # [h, w, N] -> [N, h * w] bits
+            flat = np.transpose(gt_masks, [2, 0, 1]).reshape(gt_masks.shape[-1], -1)
+            masks.append(np.packbits(flat.astype(bool), axis=1))
+
+        images.flush()
+        del images
+        count = len(metas)
+        if count:
+            np.save(os.path.join(shard_dir, "image_meta.npy"), np.stack(metas))
+            np.save(os.path.join(shard_dir, "image_ids.npy"), np.array(source_ids, dtype=np.int64))
+            np.save(os.path.join(shard_dir, "instance_offsets.npy"), np.array(offsets, dtype=np.int64))
+            np.save(os.path.join(shard_dir, "class_ids.npy"), np.concatenate(class_ids))
+            np.save(os.path.join(shard_dir, "boxes.npy"), np.concatenate(boxes))
+            np.save(os.path.join(shard_dir, "keypoints.npy"), np.concatenate(keypoints))
+            np.save(os.path.join(shard_dir, "masks.npy"), np.concatenate(masks))
+            shards.append({"name": shard_name, "count": count,
+                           "mask_shape": [int(d) for d in mask_shape]})
+            written += count
+        if verbose:
+            print("Wrote {} images to {}".format(count, shard_dir))
+
+    manifest = {
+        "config": _config_values(config),
+        "image_shape": list(image_shape),
+        "class_info": dataset.class_info,
+        "image_info": [{"id": dataset.image_info[i]["id"],
+                        "source": dataset.image_info[i]["source"]}
+                       for i in image_ids],
+        "shards": shards,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, default=str)
+    return written
+
+
+############################################################
+#  Reader
+############################################################
+
+class ShardDataset(utils.Dataset):
+    """Serves the records written by write_shards(). Arrays are memory-mapped
+    read-only, so images and boxes are returned as views into the files.
+
+    load_image_gt_keypoints() detects this dataset through load_molded()
+    and skips the resize and mini-mask steps.
+    """
+
+    def load_shards(self, shard_dir, config=None):
+        """Loads the manifest and maps all shards of shard_dir.
+        config: If given, verifies that it matches the config the shards
+            were written with.
+        """
+        with open(os.path.join(shard_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        if config is not None:
+            assert manifest["config"] == _config_values(config), \
+                "Shards were written with a different config: {}".format(manifest["config"])
+        self.shard_dir = shard_dir
+        self._use_mini_mask = manifest["config"]["USE_MINI_MASK"]
+
+        for info in manifest["class_info"]:
+            if info["id"] != 0:
+                self.add_class(info["source"], info["id"], info["name"])
+
+        self._shards = []
+        for k, shard in enumerate(manifest["shards"]):
+            path = os.path.join(shard_dir, shard["name"])
+            arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                      for name in ["images", "image_meta", "image_ids", "instance_offsets",
+                                   "class_ids", "boxes", "keypoints", "masks"]}
+            arrays["mask_shape"] = tuple(shard["mask_shape"])
+            self._shards.append(arrays)
+            for i in range(shard["count"]):
+                source_id = int(arrays["image_ids"][i])
+                source_info = manifest["image_info"][source_id]
+                self.add_image(source_info["source"], image_id=source_info["id"],
+                               path=path, shard=k, index=i)
+
+    def load_image(self, image_id):
+        """Returns the resized and padded [H, W, 3] uint8 image."""
+        info = self.image_info[image_id]
+        return self._shards[info["shard"]]["images"][info["index"]]
+
+    def load_molded(self, image_id, use_mini_mask=True):
+        """Returns the stored outputs of load_image_gt_keypoints():
+        image, image_meta, class_ids, bbox, mask, keypoints
+        """
+        info = self.image_info[image_id]
+        shard = self._shards[info["shard"]]
+        i = info["index"]
+        a, b = shard["instance_offsets"][i], shard["instance_offsets"][i + 1]
+
+        image = shard["images"][i]
+        image_meta = np.array(shard["image_meta"][i])
+        # Point the meta data at the ID in this dataset
+        image_meta[0] = image_id
+        class_ids = shard["class_ids"][a:b]
+        bbox = shard["boxes"][a:b]
+        keypoints = shard["keypoints"][a:b]
+
+        assert use_mini_mask == self._use_mini_mask, \
+            "Shards were written with USE_MINI_MASK={}".format(self._use_mini_mask)
+        h, w = shard["mask_shape"]
+        bits = np.unpackbits(shard["masks"][a:b], axis=1)[:, :h * w]
+        mask = np.transpose(bits.reshape(b - a, h, w), [1, 2, 0]).astype(bool)
+        return image, image_meta, class_ids, bbox, mask, keypoints
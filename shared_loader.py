@@ -0,0 +1,184 @@
+"""
+Mask R-CNN
+Shared-memory batch transport for training generators.
+
+With fit_generator(..., use_multiprocessing=True) every batch built by a
+worker process is pickled, sent through a pipe and unpickled by the trainer.
+For keypoint batches (float32 images, float64 mini-masks of
+MAX_GT_INSTANCES instances) that is many MB of serialization per step.
+
+SharedBatchLoader instead allocates a ring of batch slots in shared memory
+before starting its workers. A worker takes a free slot, copies its next
+batch into it and passes the slot index back. The trainer gets numpy views
+of the slot, with no pickling and no copy, and the slot returns to the free
+list when the trainer asks for the next batch.
+
+Usage:
+    loader = SharedBatchLoader(
+        lambda: data_generator_keypoint(dataset, config, batch_size=2),
+        num_workers=4)
+    model.keras_model.fit_generator(loader, workers=0, ...)
+    loader.close()
+"""
+
+import os
+import random
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+
+# Slot buffers are aligned to this many bytes
+_ALIGNMENT = 64
+
+
+def _flatten(batch):
+    """Returns the arrays of an (inputs, outputs) batch as one list and the
+    number of inputs.
+    """
+    inputs, outputs = batch
+    return list(inputs) + list(outputs), len(inputs)
+
+
+class SlotLayout(object):
+    """Shapes, dtypes and byte offsets of the arrays of one batch slot."""
+
+    def __init__(self, arrays, num_inputs):
+        self.shapes = [a.shape for a in arrays]
+        self.dtypes = [a.dtype for a in arrays]
+        self.num_inputs = num_inputs
+        self.offsets = []
+        offset = 0
+        for a in arrays:
+            self.offsets.append(offset)
+            offset += (a.nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+        self.nbytes = offset
+
+    def views(self, buffer):
+        """Returns numpy views of the arrays of a slot buffer."""
+        return [np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)),
+                              offset=offset).reshape(shape)
+                for shape, dtype, offset in zip(self.shapes, self.dtypes, self.offsets)]
+
+    def matches(self, arrays):
+        return [a.shape for a in arrays] == self.shapes and \
+            [a.dtype for a in arrays] == self.dtypes
+
+
+def _worker(generator_fn, worker_id, seed, buffers, layout, free_slots, filled_slots, stop):
+    """Worker process loop: fills free slots with batches from its own
+    generator until it receives None or stop is set.
+    """
+    # Forked workers inherit the random state of the parent. Give each one
+    # its own, or they all produce the same batches.
+    np.random.seed((seed + worker_id) % (2 ** 32))
+    random.seed(seed + worker_id)
+    try:
+        generator = generator_fn()
+        views = [layout.views(b) for b in buffers]
+        while True:
+            slot = free_slots.get()
+            if slot is None or stop.is_set():
+                break
+            arrays, num_inputs = _flatten(next(generator))
+            assert num_inputs == layout.num_inputs and layout.matches(arrays), \
+                "All batches must have the same shapes and dtypes"
+            for dst, src in zip(views[slot], arrays):
+                np.copyto(dst, src)
+            filled_slots.put(slot)
+    except Exception:
+        filled_slots.put(traceback.format_exc())
+
+
+class SharedBatchLoader(object):
+    """Iterator over batches produced by worker processes into a ring of
+    shared-memory slots.
+
+    generator_fn: Function returning a new batch generator. Called once in
+        each worker and once in this process to learn the batch layout.
+        Batches are (inputs, outputs) lists of arrays of fixed shapes.
+    num_workers: Number of worker processes.
+    num_slots: Number of batch slots. Defaults to 2 per worker.
+    seed: Base random seed. Worker i is seeded with seed + i.
+
+    The arrays returned by next() are views into a slot and stay valid until
+    the following call to next(). Copy them to keep them longer.
+    """
+
+    def __init__(self, generator_fn, num_workers=2, num_slots=None, seed=None):
+        self.num_workers = max(num_workers, 1)
+        self.num_slots = num_slots or 2 * self.num_workers
+        assert self.num_slots >= 2, "Need at least 2 slots"
+        seed = seed if seed is not None else int.from_bytes(os.urandom(4), "little")
+
+        # The first batch defines the slot layout. It's also the first batch
+        # returned, so it's not wasted.
+        arrays, num_inputs = _flatten(next(generator_fn()))
+        self.layout = SlotLayout(arrays, num_inputs)
+        self._buffers = [multiprocessing.RawArray("b", self.layout.nbytes)
+                         for _ in range(self.num_slots)]
+        self._views = [self.layout.views(b) for b in self._buffers]
+        for dst, src in zip(self._views[0], arrays):
+            np.copyto(dst, src)
+        self._pending = [0]
+        self._current = None
+
+        self._free_slots = multiprocessing.Queue()
+        self._filled_slots = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+        for slot in range(1, self.num_slots):
+            self._free_slots.put(slot)
+        self._workers = []
+        for i in range(self.num_workers):
+            p = multiprocessing.Process(
+                target=_worker,
+                args=(generator_fn, i, seed, self._buffers, self.layout,
+                      self._free_slots, self._filled_slots, self._stop))
+            p.daemon = True
+            p.start()
+            self._workers.append(p)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # The trainer is done with the previous batch
+        if self._current is not None:
+            self._free_slots.put(self._current)
+            self._current = None
+        if self._pending:
+            slot = self._pending.pop()
+        else:
+            slot = self._filled_slots.get()
+            if isinstance(slot, str):
+                self.close()
+                raise RuntimeError("Data loader worker failed:\n" + slot)
+        self._current = slot
+        arrays = self._views[slot]
+        return arrays[:self.layout.num_inputs], arrays[self.layout.num_inputs:]
+
+    next = __next__
+
+    def qsize(self):
+        """Returns the number of batches that are ready to be returned."""
+        return self._filled_slots.qsize() + len(self._pending)
+
+    def close(self):
+        """Stops the worker processes."""
+        if not self._workers:
+            return
+        self._stop.set()
+        for _ in self._workers:
+            self._free_slots.put(None)
+        for p in self._workers:
+            p.join(timeout=5)
+            if p.is_alive():
+                logging.warning("Terminating data loader worker {}".format(p.pid))
+                p.terminate()
+        self._workers = []
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,168 @@
+"""
+Mask R-CNN
+Per-step training timeline: time waiting for data vs. time in the step.
+
+fit_generator() takes each batch from the queue its workers fill, then runs
+the training step. If the workers can't keep up, the training loop waits on
+the queue and the GPU idles. StepTimeline records for every step:
+
+    wait_ms      Time from the end of the previous step to the start of
+                 this one, which is mostly the wait for the batch.
+    step_ms      Time inside the training step.
+    queue_depth  Batches ready in the queue when the step starts, out of
+                 max_queue_size. A queue that stays near 0 means the
+                 workers are the bottleneck. One that stays full means
+                 the model is.
+    losses       The values of the losses the model reports.
+
+They are written as TensorBoard scalars under <log_dir>/timeline and as a
+CSV file <log_dir>/timeline.csv with one row per step.
+
+Usage:
+    timeline = StepTimeline(model.log_dir, max_queue_size=100,
+                            loss_names=model.loss_names)
+    keras_model.fit_generator(..., callbacks=[timeline])
+"""
+
+import os
+import csv
+import time
+import logging
+
+import numpy as np
+import tensorflow as tf
+import keras
+from keras.utils import data_utils
+
+
+class StepTimeline(keras.callbacks.Callback):
+    """Keras callback that records the data wait, step time, queue depth
+    and losses of every training step.
+
+    log_dir: Directory of the TensorBoard events and the CSV file.
+    max_queue_size: The max_queue_size passed to fit_generator().
+    loss_names: Names of the losses in the batch logs to record.
+    queue_depth_fn: Function returning the number of batches ready. By
+        default the depth of the queue of the Keras enqueuer that
+        fit_generator() starts is used.
+    summary_every: Write TensorBoard scalars every this many steps. The CSV
+        gets every step.
+    initial_step: Number of the first step, to continue the timeline of an
+        earlier run in the same log_dir.
+    """
+
+    def __init__(self, log_dir, max_queue_size=10, loss_names=(), queue_depth_fn=None,
+                 summary_every=10, initial_step=0):
+        super(StepTimeline, self).__init__()
+        self.log_dir = log_dir
+        self.max_queue_size = max_queue_size
+        self.loss_names = list(loss_names)
+        self.queue_depth_fn = queue_depth_fn
+        self.summary_every = summary_every
+        self.step = initial_step
+        self._epoch = 0
+        self._enqueuer = None
+        self._patched = []
+        self._writer = None
+        self._csv_file = None
+        self._csv = None
+        self._last_end = None
+        self._begin = None
+        self._wait = None
+        self._depth = None
+
+    def _capture_enqueuers(self):
+        """fit_generator() creates its enqueuer after on_train_begin(). Wrap
+        the start() of the Keras enqueuers to find out which one it is.
+        """
+        callback = self
+        for cls in [data_utils.GeneratorEnqueuer, data_utils.OrderedEnqueuer]:
+            start = cls.__dict__["start"]
+
+            def patched(enqueuer, *args, _start=start, **kwargs):
+                if callback._enqueuer is None:
+                    callback._enqueuer = enqueuer
+                return _start(enqueuer, *args, **kwargs)
+            setattr(cls, "start", patched)
+            self._patched.append((cls, start))
+
+    def _restore_enqueuers(self):
+        for cls, start in self._patched:
+            setattr(cls, "start", start)
+        self._patched = []
+
+    def queue_depth(self):
+        """Returns the number of batches ready, or -1 if unknown."""
+        try:
+            if self.queue_depth_fn is not None:
+                return int(self.queue_depth_fn())
+            queue = getattr(self._enqueuer, "queue", None)
+            if queue is not None:
+                return queue.qsize()
+        except NotImplementedError:
+            # multiprocessing.Queue.qsize() on macOS
+            pass
+        return -1
+
+    def on_train_begin(self, logs=None):
+        if self.queue_depth_fn is None:
+            self._capture_enqueuers()
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._writer = tf.summary.FileWriter(os.path.join(self.log_dir, "timeline"))
+        path = os.path.join(self.log_dir, "timeline.csv")
+        new_file = not os.path.exists(path)
+        self._csv_file = open(path, "a", newline="")
+        self._csv = csv.writer(self._csv_file)
+        if new_file:
+            self._csv.writerow(["step", "epoch", "wait_ms", "step_ms", "queue_depth"] +
+                               self.loss_names)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        self._last_end = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self._begin = time.time()
+        self._wait = self._begin - self._last_end if self._last_end else 0.0
+        self._depth = self.queue_depth()
+        if self._enqueuer is not None and self._patched:
+            # Found it. Put the enqueuer classes back as they were.
+            self._restore_enqueuers()
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        end = time.time()
+        step_time = end - self._begin
+        self._last_end = end
+        losses = [float(np.mean(logs.get(name, np.nan))) for name in self.loss_names]
+        self._csv.writerow(["{}".format(self.step), self._epoch,
+                            "{:.1f}".format(self._wait * 1000), "{:.1f}".format(step_time * 1000),
+                            self._depth] + ["{:.5g}".format(l) for l in losses])
+        if self.step % self.summary_every == 0:
+            values = [("timeline/wait_ms", self._wait * 1000),
+                      ("timeline/step_ms", step_time * 1000),
+                      ("timeline/wait_fraction", self._wait / max(self._wait + step_time, 1e-9))]
+            if self._depth >= 0:
+                values += [("timeline/queue_depth", self._depth),
+                           ("timeline/queue_fill", self._depth / float(max(self.max_queue_size, 1)))]
+            values += [("losses/" + name, l) for name, l in zip(self.loss_names, losses)]
+            summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)
+                                        for tag, value in values])
+            self._writer.add_summary(summary, self.step)
+        self.step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._csv_file.flush()
+        self._writer.flush()
+
+    def on_train_end(self, logs=None):
+        self._restore_enqueuers()
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._enqueuer is None and self.queue_depth_fn is None:
+            logging.info("StepTimeline: no Keras enqueuer found, queue depth not recorded")
+        self._enqueuer = None
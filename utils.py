@@ -11,14 +11,19 @@ import sys
 import os
 import math
 import random
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 import scipy.misc
 import skimage.color
+import skimage.draw
 import skimage.io
 import skimage.transform
 import urllib.request
 import shutil
+import cv2
 import video_dataset
 
 # URL from which to download the latest COCO trained weights
@@ -48,35 +53,6 @@ def bilinear_upsample_weights(factor, number_of_classes):
         weights[:, :, i, i] = upsample_kernel
     return weights
 
-def keypoint_to_mask(keypoints,height,width):
-    """Convert keypoints to masks and it's weight.
-       keypoints: [num_person, num_keypoint, 3].
-       height,width: the generated mask shape
-
-       Returns:
-           keypoint_mask: A bool array of shape [height, width, num_person, num_keypoint] with
-            one mask per joint..
-           keypoint_weight: A int array of shape [num_person, num_keypoint] one value per joint
-           0: not visible and without annotations
-           1: not visible but with annotations
-           2: visible and with annotations
-       """
-    shape = np.shape(keypoints)
-
-    keypoint_mask = np.zeros([height,width,shape[0],shape[1]],dtype=bool)
-    keypoint_weight = np.zeros([shape[0],shape[1]],dtype=int)
-    for i in range(shape[0]):
-        for j in range(shape[1]):
-            J = keypoints[i,j]
-            # print(J)
-            if(J[2]):
-                keypoint_mask[J[1],J[0],i,j] = 1
-            keypoint_weight[i, j] = J[2]
-    # keypoint_mask = np.reshape(keypoint_mask,[height,width,-1])
-    # keypoint_weight = np.reshape(keypoint_weight,[-1])
-    return keypoint_mask, keypoint_weight
-
-
 ############################################################
 #  Bounding Boxes
 ############################################################
@@ -152,6 +128,173 @@ def compute_overlaps(boxes1, boxes2):
     return overlaps
 
 
+def compute_overlaps_broadcast(boxes1, boxes2):
+    """Computes IoU overlaps between two sets of boxes in one broadcast.
+    Same values as compute_overlaps(), without the Python loop over boxes2.
+    boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    :return overlaps [boxes1.shape[0], boxes2.shape[0]]
+    """
+    # Areas of anchors and GT boxes
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    # Intersections, computed in place to keep the number of
+    # [boxes1 count, boxes2 count] temporaries low.
+    h = np.minimum(boxes2[:, 2], boxes1[:, 2, None])
+    h -= np.maximum(boxes2[:, 0], boxes1[:, 0, None])
+    np.maximum(h, 0, out=h)
+    w = np.minimum(boxes2[:, 3], boxes1[:, 3, None])
+    w -= np.maximum(boxes2[:, 1], boxes1[:, 1, None])
+    np.maximum(w, 0, out=w)
+    intersection = w
+    intersection *= h
+    del h
+    union = area1[:, None] + area2[None, :]
+    union -= intersection
+    intersection /= union
+    return intersection
+
+
+def anchor_gt_overlaps(anchors, gt_boxes, prefilter=True, block_size=4096):
+    """Matches anchors to GT boxes by IoU without building the full overlap
+    matrix. Anchors are processed in blocks so the temporaries stay in cache.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    prefilter: If True, only computes IoU for anchors that intersect the
+        bounding box of all GT boxes. The others have IoU 0 with every GT box.
+    block_size: Number of anchors per block.
+
+    Returns the same values as taking argmax/max of compute_overlaps():
+    anchor_iou_max: [num_anchors] Best IoU of each anchor.
+    anchor_iou_argmax: [num_anchors] Index of the best GT box of each anchor.
+    gt_iou_argmax: [num_gt_boxes] Index of the best anchor of each GT box.
+    """
+    if prefilter:
+        # Anchors that have a positive intersection with the GT hull
+        y1, x1 = np.min(gt_boxes[:, 0]), np.min(gt_boxes[:, 1])
+        y2, x2 = np.max(gt_boxes[:, 2]), np.max(gt_boxes[:, 3])
+        candidates = np.where((anchors[:, 0] < y2) & (anchors[:, 2] > y1) &
+                              (anchors[:, 1] < x2) & (anchors[:, 3] > x1))[0]
+    else:
+        candidates = np.arange(anchors.shape[0])
+
+    anchor_iou_max = np.zeros([anchors.shape[0]])
+    anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+    # Best IoU of each GT box so far. Anchors outside the candidates have
+    # IoU 0, and argmax over an all zero column picks anchor 0.
+    gt_iou_max = np.zeros([gt_boxes.shape[0]])
+    gt_iou_argmax = np.zeros([gt_boxes.shape[0]], dtype=np.int64)
+    gt_range = np.arange(gt_boxes.shape[0])
+
+    for i in range(0, candidates.shape[0], block_size):
+        ix = candidates[i:i + block_size]
+        overlaps = compute_overlaps_broadcast(anchors[ix], gt_boxes)
+        argmax = np.argmax(overlaps, axis=1)
+        anchor_iou_argmax[ix] = argmax
+        anchor_iou_max[ix] = overlaps[np.arange(ix.shape[0]), argmax]
+        # Keep the first best anchor: only strictly better blocks replace it
+        argmax = np.argmax(overlaps, axis=0)
+        block_max = overlaps[argmax, gt_range]
+        better = block_max > gt_iou_max
+        gt_iou_max[better] = block_max[better]
+        gt_iou_argmax[better] = ix[argmax[better]]
+    return anchor_iou_max, anchor_iou_argmax, gt_iou_argmax
+
+
+def sparse_anchor_gt_overlaps(layout, gt_boxes):
+    """Same results as anchor_gt_overlaps() for the anchors of an
+    AnchorLayout, but only computes IoU for anchor/GT pairs that can
+    intersect. Anchors lie on a regular grid per pyramid level, so the
+    anchors near a GT box are found from its coordinates instead of by
+    comparing it with all anchors. Memory grows with the number of
+    overlapping pairs rather than anchors times GT boxes.
+
+    layout: AnchorLayout from get_pyramid_anchors()
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+
+    Returns anchor_iou_max, anchor_iou_argmax, gt_iou_argmax
+    """
+    anchors = layout.anchors
+    num_anchors = anchors.shape[0]
+    num_gt = gt_boxes.shape[0]
+    ratios = np.array(layout.ratios, dtype=np.float64)
+    per_location = layout.anchors_per_location
+    gt = gt_boxes.astype(np.float64)
+
+    anchor_iou_max = np.zeros([num_anchors])
+    anchor_iou_argmax = np.zeros([num_anchors], dtype=np.int64)
+    # Anchors without any overlap keep IoU 0 and GT 0, and GT boxes without
+    # any overlap keep anchor 0, as argmax over all zeros does.
+    gt_iou_max = np.zeros([num_gt])
+    gt_iou_argmax = np.zeros([num_gt], dtype=np.int64)
+
+    # Levels are processed in anchor order, so each level finalizes its own
+    # anchors and only strictly better IoUs replace the best anchor of a GT.
+    for level in range(len(layout.scales)):
+        step = layout.anchor_stride * layout.feature_strides[level]
+        rows, cols = layout.grid_shapes[level]
+        # An anchor can only intersect a GT box if its center is closer to
+        # the box than its largest half height and width.
+        half_h = np.max(layout.scales[level] / np.sqrt(ratios)) / 2
+        half_w = np.max(layout.scales[level] * np.sqrt(ratios)) / 2
+        y_lo = np.maximum(np.floor((gt[:, 0] - half_h) / step), 0).astype(np.int64)
+        y_hi = np.minimum(np.ceil((gt[:, 2] + half_h) / step), rows - 1).astype(np.int64)
+        x_lo = np.maximum(np.floor((gt[:, 1] - half_w) / step), 0).astype(np.int64)
+        x_hi = np.minimum(np.ceil((gt[:, 3] + half_w) / step), cols - 1).astype(np.int64)
+        ny = np.maximum(y_hi - y_lo + 1, 0)
+        nx = np.maximum(x_hi - x_lo + 1, 0)
+        counts = ny * nx * per_location
+        level_offset = layout.level_offsets[level]
+        if not np.any(counts):
+            continue
+
+        # Enumerate the grid window of every GT box without a Python loop.
+        # Anchors are ordered by row, column and then ratio.
+        pair_gts = np.repeat(np.arange(num_gt), counts)
+        local = np.arange(pair_gts.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell = local // per_location
+        pair_anchors = level_offset + local % per_location + per_location * (
+            (y_lo[pair_gts] + cell // nx[pair_gts]) * cols +
+            x_lo[pair_gts] + cell % nx[pair_gts])
+        del local, cell
+
+        # IoU of the pairs. Same operations as compute_overlaps_broadcast()
+        a = anchors[pair_anchors]
+        b = gt_boxes[pair_gts]
+        h = np.minimum(b[:, 2], a[:, 2]) - np.maximum(b[:, 0], a[:, 0])
+        w = np.minimum(b[:, 3], a[:, 3]) - np.maximum(b[:, 1], a[:, 1])
+        intersection = np.maximum(w, 0) * np.maximum(h, 0)
+        union = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + \
+            (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        union -= intersection
+        iou = intersection / union
+        del a, b, h, w, intersection, union
+        keep = np.where(iou > 0)[0]
+        if keep.shape[0] == 0:
+            continue
+        pair_anchors, pair_gts, iou = pair_anchors[keep], pair_gts[keep], iou[keep]
+
+        # Best GT of each anchor. Sorting by descending IoU and then index
+        # picks the first maximum, as argmax does.
+        order = np.lexsort((pair_gts, -iou, pair_anchors))
+        sorted_anchors = pair_anchors[order]
+        first = order[np.r_[True, sorted_anchors[1:] != sorted_anchors[:-1]]]
+        anchor_iou_max[pair_anchors[first]] = iou[first]
+        anchor_iou_argmax[pair_anchors[first]] = pair_gts[first]
+
+        # Best anchor of each GT box in this level
+        order = np.lexsort((pair_anchors, -iou, pair_gts))
+        sorted_gts = pair_gts[order]
+        first = order[np.r_[True, sorted_gts[1:] != sorted_gts[:-1]]]
+        better = iou[first] > gt_iou_max[pair_gts[first]]
+        first = first[better]
+        gt_iou_max[pair_gts[first]] = iou[first]
+        gt_iou_argmax[pair_gts[first]] = pair_anchors[first]
+
+    return anchor_iou_max, anchor_iou_argmax, gt_iou_argmax
+
+
 def compute_overlaps_masks(masks1, masks2):
     '''Computes IoU overlaps between two sets of masks.
     masks1, masks2: [Height, Width, instances]
@@ -309,6 +452,10 @@ class Dataset(object):
         # Background is always the first class
         self.class_info = [{"source": "", "id": 0, "name": "BG"}]
         self.source_class_ids = {}
+        # Optional cache of decoded frames. See enable_frame_cache()
+        self.frame_cache = None
+        # Frame shape of each (path, side). See image_shape()
+        self._image_shapes = {}
 
     def add_class(self, source, class_id, class_name):
         assert "." not in source, "Source name cannot contain a dot"
@@ -413,17 +560,57 @@ class Dataset(object):
         """
         return self.image_info[image_id]["path"]
 
+    def enable_frame_cache(self, max_bytes=1 << 30, cache_dir=None):
+        """Caches decoded frames so later epochs skip the video decode.
+        Call after prepare().
+
+        max_bytes: Byte budget of the in-memory LRU tier.
+        cache_dir: If given, also keep the frames in a memory-mapped file in
+            this directory. All frames must have the shape of the first image.
+
+        Returns the FrameCache. Its stats() reports hits and misses.
+        """
+        import frame_cache
+        frame_shape = None
+        if cache_dir:
+            frame_shape = self.load_image(self.image_ids[0]).shape
+        self.frame_cache = frame_cache.FrameCache(
+            max_bytes=max_bytes, cache_dir=cache_dir,
+            num_images=len(self.image_info), frame_shape=frame_shape,
+            key=frame_cache.image_list_key(self.image_info))
+        return self.frame_cache
+
     def load_image(self, image_id):
         """Load the specified image and return a [H,W,3] Numpy array.
         """
+        if self.frame_cache is not None:
+            image = self.frame_cache.get(image_id)
+            if image is not None:
+                return image
         # Load image
-        image = video_dataset.Dataset_from_videos([self.image_info[image_id]['path']]).get_frame(int(self.image_info[image_id]['frame']), self.image_info[image_id]['side'])
+        # Frames are decoded through a process-wide pool of open video
+        # handles, so consecutive frames of a file don't reopen or seek it.
+        info = self.image_info[image_id]
+        image = video_dataset.read_frame(info['path'], int(info['frame']), info['side'])
         # image = skimage.io.imread(self.image_info[image_id]['path'])
         # If grayscale. Convert to RGB for consistency.
         if image.ndim != 3:
             image = skimage.color.gray2rgb(image)
+        if self.frame_cache is not None:
+            self.frame_cache.put(image_id, image)
         return image
 
+    def image_shape(self, image_id):
+        """Returns the [H,W,3] shape of an image without decoding it again.
+        All frames of one side of a video have the same shape, so only the
+        first image of each (path, side) is decoded.
+        """
+        info = self.image_info[image_id]
+        key = (info['path'], info.get('side'))
+        if key not in self._image_shapes:
+            self._image_shapes[key] = self.load_image(image_id).shape
+        return self._image_shapes[key]
+
     def load_mask(self, image_id):
         """Load instance masks for the given image.
 
@@ -442,6 +629,39 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_mask_polygons(self, image_id):
+        """Load instance masks for the given image as polygons.
+
+        Datasets that store masks as contours can override this method, so
+        load_image_gt() transforms the vertices and draws the masks at
+        training resolution instead of resizing full size masks from
+        load_mask().
+
+        Returns:
+            polygons: A list with one list of [num_vertices, (x, y)]
+                contours per instance, in pixels of the original image.
+            class_ids: a 1D array of class IDs of the instances.
+            Or None if the dataset has no polygons, which is the default.
+        """
+        return None
+
+    def load_keypoints_compact(self, image_id):
+        """Load keypoints and boxes for the given image without masks.
+
+        Keypoint-only datasets can override this method, so
+        load_image_gt_keypoints() works on the boxes directly instead of
+        deriving them from full size masks of load_keypoints(). The masks
+        of these instances fill their boxes.
+
+        Returns:
+            keypoints: [num_instances, num_keypoints, (x, y, v)]
+            bbox: [num_instances, (y1, x1, y2, x2)] in pixels of the
+                original image.
+            class_ids: a 1D array of class IDs of the instances.
+            Or None to use load_keypoints(), which is the default.
+        """
+        return None
+
     def load_keypoints(self, image_id):
         """Load keypoints for the given image.
 
@@ -481,8 +701,27 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
     scale: The scale factor used to resize the image
     padding: Padding added to the image [(top, bottom), (left, right), (0, 0)]
     """
-    # Default window (y1, x1, y2, x2) and default scale == 1.
     h, w = image.shape[:2]
+    _, window, scale, padding = resize_image_shape(image.shape, min_dim, max_dim, padding)
+    # Resize image and mask
+    if scale != 1:
+        image = scipy.misc.imresize(
+            image, (round(h * scale), round(w * scale)))
+    # Need padding?
+    if padding:
+        image = np.pad(image, padding, mode='constant', constant_values=0)
+    return image, window, scale, padding
+
+
+def resize_image_shape(image_shape, min_dim=None, max_dim=None, padding=False):
+    """The geometry of resize_image() for an image of the given shape,
+    without an image.
+
+    Returns the shape of the resized image and the window, scale and
+    padding resize_image() returns.
+    """
+    # Default window (y1, x1, y2, x2) and default scale == 1.
+    h, w = image_shape[:2]
     window = (0, 0, h, w)
     scale = 1
 
@@ -495,22 +734,18 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
         image_max = max(h, w)
         if round(image_max * scale) > max_dim:
             scale = max_dim / image_max
-    # Resize image and mask
     if scale != 1:
-        image = scipy.misc.imresize(
-            image, (round(h * scale), round(w * scale)))
+        h, w = round(h * scale), round(w * scale)
     # Need padding?
     if padding:
-        # Get new height and width
-        h, w = image.shape[:2]
         top_pad = (max_dim - h) // 2
         bottom_pad = max_dim - h - top_pad
         left_pad = (max_dim - w) // 2
         right_pad = max_dim - w - left_pad
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-        image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
-    return image, window, scale, padding
+        h, w = max_dim, max_dim
+    return (h, w) + tuple(image_shape[2:]), window, scale, padding
 
 
 def resize_mask(mask, scale, padding):
@@ -562,69 +797,109 @@ def get_keypoints():
         'left_ankle': 'right_ankle'
     }
     return keypoints, keypoint_flip_map
+@functools.lru_cache(maxsize=16)
+def _keypoint_flip_permutation(keypoints, flip_pairs):
+    perm = np.arange(len(keypoints))
+    for lkp, rkp in flip_pairs:
+        lid = keypoints.index(lkp)
+        rid = keypoints.index(rkp)
+        perm[lid] = rid
+        perm[rid] = lid
+    perm.flags.writeable = False
+    return perm
+
+
+def keypoint_flip_permutation(keypoints, keypoint_flip_map):
+    """Returns the [num_keypoint] index array that swaps left and right
+    keypoints: flipped = keypoint_coords[:, perm]. Computed once per keypoint
+    schema. keypoints and keypoint_flip_map are accessible from get_keypoints().
+    """
+    return _keypoint_flip_permutation(tuple(keypoints), tuple(keypoint_flip_map.items()))
+
+
 def flip_keypoints(keypoints, keypoint_flip_map, keypoint_coords, width):
     """Left/right flip keypoint_coords. keypoints and keypoint_flip_map are
     accessible from get_keypoints().
     keypoint_coords:[ni,_person, num_keypoint, 3]
     width: image_width
     """
-
-    flipped_kps = keypoint_coords.copy()
-    for lkp, rkp in keypoint_flip_map.items():
-        lid = keypoints.index(lkp)
-        rid = keypoints.index(rkp)
-        flipped_kps[:, lid, :] = keypoint_coords[:, rid, :]
-        flipped_kps[:, rid, :] = keypoint_coords[:, lid, :]
+    perm = keypoint_flip_permutation(keypoints, keypoint_flip_map)
+    flipped_kps = keypoint_coords[:, perm, :]
 
     # Flip x coordinates
     flipped_kps[:, :, 0] = width - flipped_kps[:, :, 0] - 1
     # Maintain COCO convention that if visibility == 0, then x, y = 0
-    inds = np.where(flipped_kps[:, :, 2] == 0)
-    flipped_kps[inds[0], inds[1], 0] = 0
+    flipped_kps[:, :, 0][flipped_kps[:, :, 2] == 0] = 0
     return flipped_kps
+
+
 def resize_keypoints(keypoint, new_size, scale, padding):
     """Resizes a keypoint  using the given scale and padding.
         Typically, you get the scale and padding from resize_image() to
         ensure both, the image and the mask, are resized consistently.
-        keypoint: [num_person, num_keypoint, 3]
+        keypoint: [num_person, num_keypoint, 3]. Updated in place.
         scale: mask scaling factor
         padding: Padding to add to the mask in the form
                 [(top, bottom), (left, right), (0, 0)]
         """
-    keypoint_shape = np.shape(keypoint)
-    num_person = keypoint_shape[0]
-    num_keypoint = keypoint_shape[1]
-    for i in range(num_person):
-        for j in range(num_keypoint):
-            x = keypoint[i,j,0]
-            y = keypoint[i,j,1]
-            vis = keypoint[i,j,2]
-            #scale
-            x = int(x*scale+0.5)
-            y = int(y*scale +0.5)
-            if(x >=new_size[1]):
-                x = new_size[1] -1
-            if(y>= new_size[0]):
-                y = new_size[0] -1
-            #padding
-            x = x + padding[1][0]
-            y = y + padding[0][0]
-            keypoint[i,j,:2] = [x,y]
-
-    # keypoint[:,:,0] = np.array(keypoint[:,:,0]*scale + 0.5).astype(int)
-    # keypoint[:,:,1] = np.array(keypoint[:,:,1]*scale + 0.5).astype(int)
-    # X = keypoint[:,:,0]
-    # Y = keypoint[:,:,1]
-    # X[X>=new_size[1]] = new_size[1] -1
-    # Y[Y>=new_size[0]] = new_size[0] - 1
-    # X = X + padding[1,0]
-    # Y = Y + padding[0,0]
-    # keypoint[:, :, 0] =X
-    # keypoint[:, :, 1] = Y
-
+    # Scale and round like int(x * scale + 0.5), clamp to the resized image
+    # and shift by the padding.
+    x = (keypoint[:, :, 0] * scale + 0.5).astype(int)
+    y = (keypoint[:, :, 1] * scale + 0.5).astype(int)
+    keypoint[:, :, 0] = np.minimum(x, new_size[1] - 1) + padding[1][0]
+    keypoint[:, :, 1] = np.minimum(y, new_size[0] - 1) + padding[0][0]
     return keypoint
 
 
+# cv2 nearest neighbour resize that samples pixel centers like PIL (and so
+# scipy.misc.imresize(..., interp='nearest')). Older OpenCV lacks it.
+NEAREST_INTERPOLATION = getattr(cv2, "INTER_NEAREST_EXACT", cv2.INTER_NEAREST)
+
+# Thread pool of the mask resizing, created on first use in each process
+_mask_pool = None
+_mask_pool_pid = None
+
+# Masks resize on the thread pool only if they average at least this many
+# pixels, in or out. Below that the hand-off costs more than it saves.
+_MASK_POOL_MIN_PIXELS = 256 * 256
+
+
+def _get_mask_pool():
+    global _mask_pool, _mask_pool_pid
+    # Threads don't survive a fork, so worker processes need their own pool
+    if _mask_pool is None or _mask_pool_pid != os.getpid():
+        _mask_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+        _mask_pool_pid = os.getpid()
+    return _mask_pool
+
+
+def _resize_masks(crops, sizes, interpolation):
+    """Resizes 2D masks.
+
+    crops: List of [h, w] bool or 0/1 masks.
+    sizes: List of the (height, width) to resize each mask to.
+    Returns a list of the bool resized masks, thresholded at half.
+
+    Instance boxes rarely share a size, so every mask gets its own cv2
+    call. Large masks run on a thread pool, one chunk per thread, since cv2
+    releases the GIL. Small ones are resized faster in the calling thread
+    than a pool can hand them out.
+    """
+    def resize(items):
+        return [cv2.resize(np.multiply(crop, 255, dtype=np.uint8, casting="unsafe"),
+                           (int(size[1]), int(size[0])), interpolation=interpolation) >= 128
+                for crop, size in items]
+
+    items = list(zip(crops, sizes))
+    workers = min(4, os.cpu_count() or 1)
+    pixels = sum(max(crop.size, size[0] * size[1]) for crop, size in items)
+    if workers < 2 or len(items) < 2 or pixels < len(items) * _MASK_POOL_MIN_PIXELS:
+        return resize(items)
+    step = -(-len(items) // workers)
+    chunks = [items[i:i + step] for i in range(0, len(items), step)]
+    return [m for chunk in _get_mask_pool().map(resize, chunks) for m in chunk]
+
+
 def minimize_mask(bbox, mask, mini_shape):
     """Resize masks to a smaller version to cut memory load.
     Mini-masks can then resized back to image scale using expand_masks()
@@ -632,112 +907,187 @@ def minimize_mask(bbox, mask, mini_shape):
     See inspect_data.ipynb notebook for more details.
     """
     mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    crops = []
     for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
         y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        if m.size == 0:
+        if y2 <= y1 or x2 <= x1:
             raise Exception("Invalid bounding box with area of zero")
-        m = scipy.misc.imresize(m.astype(float), mini_shape, interp='bilinear')
-        # _positon = np.argmax(m)  # get the index of max in the a
-        # m_index, n_index = divmod(_positon, mini_shape[0])
-        # print("Max in oringal:", (m_index, n_index), m[m_index, n_index])
-        mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
+        crops.append(mask[y1:y2, x1:x2, i])
+    resized = _resize_masks(crops, [mini_shape] * len(crops), cv2.INTER_LINEAR)
+    for i, m in enumerate(resized):
+        mini_mask[:, :, i] = m
     return mini_mask
 
-# import cv2
-def minimize_keypoint_mask(bbox, keypointmask, mini_shape):
-    """Resize keypoint_mask to a smaller version to cut memory load.
-        Mini-masks can then resized back to image scale using expand_masks()
 
-        See inspect_data.ipynb notebook for more details.
-        """
-    mini_mask = np.zeros(mini_shape + (keypointmask.shape[2],keypointmask.shape[3],), dtype=bool)
-    for i in range(keypointmask.shape[2]):
-        for j in range(keypointmask.shape[3]):
-            m = keypointmask[:, :, i,j]
-            y1, x1, y2, x2 = bbox[i][:4]
-            m = m[y1:y2, x1:x2]
-            if m.size == 0:
-                raise Exception("Invalid bounding box with area of zero")
-            if m.sum() == 0:
-                mini_mask[0, 0, i,j] = 1
-                # mini_mask = mini_mask
-            else:
-                scale = np.asarray(mini_shape).astype(float) / m.shape
-                cordys, cordxs = np.where(m == np.max(m))
-                scale = np.asarray(mini_shape).astype(float) / m.shape
-                cordys = (cordys * scale[0] + 0.5).astype(int)
-                cordxs = (cordxs * scale[1] + 0.5).astype(int)
-                cordys[cordys >= mini_shape[0]] = mini_shape[0] - 1
-                cordxs[cordxs >= mini_shape[1]] = mini_shape[1] - 1
-                final_y = np.mean(cordys).astype(int)
-                final_x = np.mean(cordxs).astype(int)
-                mini_mask[final_y, final_x, i,j] = 1
-                # scale = np.asarray(mini_shape) / m.shape
-                # cord = np.where(m == int(m.max()))
-                # new_cord = np.array([cord[0] * scale[0], cord[1] * scale[1]], dtype=np.int32).reshape(2, )
-                # mini_mask[new_cord[0], new_cord[1], i,j] = 1
-    return mini_mask
+def resize_boxes(boxes, scale, padding, image_shape):
+    """Applies the scale and padding of resize_image() to boxes, so they
+    cover the pixels resize_mask() would map a box filled mask to.
 
+    boxes: [N, (y1, x1, y2, x2)] in pixels of the original image.
+    image_shape: [height, width, ...] of the resized image.
 
+    Returns: int32 [N, (y1, x1, y2, x2)]. Non empty boxes stay at least one
+    pixel high and wide, so small annotations are not scaled away.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    offset = np.array([padding[0][0], padding[1][0]] * 2)
+    resized = np.round(boxes * scale).astype(np.int32) + offset
+    resized[:, 2:] = np.maximum(resized[:, 2:], resized[:, :2] + 1)
+    limits = np.array([image_shape[0], image_shape[1]] * 2)
+    resized = np.clip(resized, 0, limits).astype(np.int32)
+    empty = (boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1]) | \
+        (resized[:, 2] <= resized[:, 0]) | (resized[:, 3] <= resized[:, 1])
+    resized[empty] = 0
+    return resized
+
+
+def flip_boxes(boxes, width):
+    """Flips boxes horizontally, like np.fliplr() on an image of the given
+    width. All zero boxes stay all zeros.
+    """
+    boxes = np.array(boxes, dtype=np.int32)
+    valid = np.any(boxes != 0, axis=1)
+    x1 = boxes[:, 1].copy()
+    boxes[valid, 1] = width - boxes[valid, 3]
+    boxes[valid, 3] = width - x1[valid]
+    return boxes
 
-def expand_keypoint_mask(bbox,mini_mask,image_shape):
-    """Resizes mini keypoint masks back to image size. Reverses the change
-        of minimize_mask().
 
-        See inspect_data.ipynb notebook for more details.
-        """
-    keypoint_mask = np.zeros(image_shape[:2] + (mini_mask.shape[2],mini_mask.shape[3]))
+def box_masks(bbox, image_shape, mini_shape=None):
+    """Masks that fill their boxes, for datasets without instance masks.
 
-    for i in range(keypoint_mask.shape[2]):
-        for j in range(keypoint_mask.shape[3]):
-            m = mini_mask[:, :, i,j]
-            y1, x1, y2, x2 = bbox[i][:4]
+    bbox: [num_instances, (y1, x1, y2, x2)]
+    image_shape: [height, width, ...] of the image.
+    mini_shape: If given, returns mini masks of this (height, width), as
+        minimize_mask() would. Otherwise masks are image sized.
 
-            h = y2 - y1
-            w = x2 - x1
-            result = np.sum(m)
-            if(result):
-                cordys, cordxs = np.where(m == np.max(m))
-                scale = np.asarray([h, w]).astype(float) / m.shape
-                cordys = (cordys * scale[0] + 0.5).astype(int)
-                cordxs = (cordxs * scale[1] + 0.5).astype(int)
+    Returns: bool array [height, width, num_instances].
+    """
+    bbox = np.asarray(bbox)
+    valid = (bbox[:, 2] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 1])
+    if mini_shape is not None:
+        return np.broadcast_to(valid, tuple(mini_shape) + valid.shape).copy()
+    mask = np.zeros(tuple(image_shape[:2]) + (bbox.shape[0],), dtype=bool)
+    for i in np.where(valid)[0]:
+        y1, x1, y2, x2 = bbox[i][:4]
+        mask[y1:y2, x1:x2, i] = True
+    return mask
 
-                cordys[cordys >= h] = h - 1
-                cordxs[cordxs >= w] = w - 1
-                m = np.zeros(np.asarray([h, w]).astype(int), dtype=bool)
-                # print("m shape:", np.shape(m))
-                final_y = np.mean(cordys).astype(int)
-                final_x = np.mean(cordxs).astype(int)
-                m[final_y, final_x] = 1
-            else:
-                m = np.zeros([h, w])
 
-            keypoint_mask[y1:y2, x1:x2, i,j] = m
+def resize_polygons(polygons, scale, padding):
+    """Applies the scale and padding of resize_image() to polygon vertices,
+    so they line up with the resized image like the output of resize_mask().
 
+    polygons: List with one list of [num_vertices, (x, y)] contours per
+        instance, in pixel coordinates.
+    scale: The scale factor returned by resize_image().
+    padding: The padding returned by resize_image().
 
-    return keypoint_mask
+    Returns a new list of float contours.
+    """
+    offset = np.array([padding[1][0], padding[0][0]], dtype=np.float64)
+    # Pixel centers are at integer coordinates
+    return [[(np.asarray(c, dtype=np.float64) + 0.5) * scale - 0.5 + offset
+             for c in contours] for contours in polygons]
+
+
+def flip_polygons(polygons, width):
+    """Flips polygon vertices horizontally, like np.fliplr() on a mask of
+    the given width.
+    """
+    flipped = []
+    for contours in polygons:
+        flipped.append([])
+        for c in contours:
+            c = np.array(c, dtype=np.float64)
+            c[:, 0] = width - 1 - c[:, 0]
+            flipped[-1].append(c)
+    return flipped
+
+
+def extract_polygon_bboxes(polygons, image_shape):
+    """Computes bounding boxes from polygon vertices, clipped to the image.
+    The polygon counterpart of extract_bboxes().
+
+    polygons: List with one list of [num_vertices, (x, y)] contours per
+        instance.
+    image_shape: [height, width, ...] of the image.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)]. Instances with
+    no pixel inside the image get an all zeros box.
+    """
+    boxes = np.zeros([len(polygons), 4], dtype=np.int32)
+    for i, contours in enumerate(polygons):
+        if not len(contours):
+            continue
+        vertices = np.concatenate([np.asarray(c).reshape(-1, 2) for c in contours])
+        # The pixels whose centers lie between the extreme vertices
+        x1, y1 = np.ceil(vertices.min(axis=0)).astype(np.int32)
+        x2, y2 = np.floor(vertices.max(axis=0)).astype(np.int32) + 1
+        x1, y1 = max(x1, 0), max(y1, 0)
+        x2, y2 = min(x2, image_shape[1]), min(y2, image_shape[0])
+        if y2 > y1 and x2 > x1:
+            boxes[i] = np.array([y1, x1, y2, x2])
+    return boxes
+
+
+def rasterize_polygons(bbox, polygons, image_shape, mini_shape=None):
+    """Draws instance masks from polygon vertices, skipping the full size
+    mask that load_mask() and resize_mask() would build.
 
+    bbox: [num_instances, (y1, x1, y2, x2)] from extract_polygon_bboxes().
+    polygons: List with one list of [num_vertices, (x, y)] contours per
+        instance, in the coordinates of the (resized) image.
+    image_shape: [height, width, ...] of the image.
+    mini_shape: If given, each instance is drawn directly into a mini mask
+        of this (height, width) spanning its box, as minimize_mask() would
+        return. Otherwise masks are image sized.
 
-def expand_mask(bbox, mini_mask, image_shape):
+    Returns: bool array [height, width, num_instances].
+    """
+    shape = tuple(mini_shape) if mini_shape is not None else tuple(image_shape[:2])
+    mask = np.zeros(shape + (len(polygons),), dtype=bool)
+    for i, contours in enumerate(polygons):
+        y1, x1, y2, x2 = bbox[i][:4]
+        if y2 <= y1 or x2 <= x1:
+            continue
+        for c in contours:
+            c = np.asarray(c, dtype=np.float64).reshape(-1, 2)
+            x, y = c[:, 0], c[:, 1]
+            if mini_shape is not None:
+                # Map pixel centers of the box to pixel centers of the mini mask
+                x = (x - x1 + 0.5) * (float(shape[1]) / (x2 - x1)) - 0.5
+                y = (y - y1 + 0.5) * (float(shape[0]) / (y2 - y1)) - 0.5
+            rr, cc = skimage.draw.polygon(y, x, shape=shape)
+            mask[rr, cc, i] = True
+    return mask
+
+
+def expand_mask(bbox, mini_mask, image_shape, crop=False, interpolation=cv2.INTER_LINEAR):
     """Resizes mini masks back to image size. Reverses the change
     of minimize_mask().
 
+    crop: If True, returns a list with one [y2 - y1, x2 - x1] bool mask per
+        instance, cropped to its box, instead of the image sized array.
+    interpolation: cv2 interpolation of the resize.
+
     See inspect_data.ipynb notebook for more details.
     """
+    sizes = [(max(int(y2 - y1), 0), max(int(x2 - x1), 0)) for y1, x1, y2, x2 in bbox[:, :4]]
+    # Boxes of zero area get empty masks
+    ids = [i for i, size in enumerate(sizes) if size[0] and size[1]]
+    masks = [np.zeros(size, dtype=bool) for size in sizes]
+    resized = _resize_masks([mini_mask[:, :, i] for i in ids], [sizes[i] for i in ids],
+                            interpolation)
+    for i, m in zip(ids, resized):
+        masks[i] = m
+    if crop:
+        return masks
+
     mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
+    for i in ids:
         y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
-        m = scipy.misc.imresize(m.astype(float), (h, w), interp='bilinear')
-        # _positon = np.argmax(m)  # get the index of max in the a
-        # m_index, n_index = divmod(_positon, w)
-        # print("Max in resize:", (m_index, n_index), m[m_index, n_index])
-        mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
-
+        mask[y1:y2, x1:x2, i] = masks[i]
     return mask
 
 
@@ -746,6 +1096,21 @@ def mold_mask(mask, config):
     pass
 
 
+def unmold_box_mask(mask, bbox):
+    """Resizes a mask generated by the neural network to the size of its box.
+    mask: [height, width] of type float. A small, typically 28x28 mask.
+    bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+
+    Returns a [y2 - y1, x2 - x1] binary mask. Its top left corner is at
+    (y1, x1) in the image.
+    """
+    threshold = 0.5
+    y1, x1, y2, x2 = bbox
+    mask = scipy.misc.imresize(
+        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
+    return np.where(mask >= threshold, 1, 0).astype(np.uint8)
+
+
 def unmold_mask(mask, bbox, image_shape):
     """Converts a mask generated by the neural network into a format similar
     to it's original shape.
@@ -754,11 +1119,8 @@ def unmold_mask(mask, bbox, image_shape):
 
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = scipy.misc.imresize(
-        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
-    mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
+    mask = unmold_box_mask(mask, bbox)
 
     # Put the mask in the right location.
     full_mask = np.zeros(image_shape[:2], dtype=np.uint8)
@@ -778,7 +1140,18 @@ def unmold_keypoint_mask(keypoints_prob, bbox, image_shape, mask, keypoint_mask_
     full_mask: [image_shape[0],image_shape[1], num_keypoints]a binary mask with the same size as the original image.
     keypoints: [num_keypoints, 3] for (x , y, valid)
     """
+    keypoints = unmold_keypoints(keypoints_prob, bbox, keypoint_mask_shape, keypoint_threshold)
+    full_mask = unmold_mask(mask,bbox,image_shape)
+    return keypoints, full_mask
 
+def unmold_keypoints(keypoints_prob, bbox, keypoint_mask_shape = (56,56), keypoint_threshold= 0.08):
+    """Converts the keypoint heatmaps of one instance to image coordinates.
+    keypoints_probe: [num_keypoints, 56*56] of type float.
+    bbox: [y1, x1, y2, x2]. The box the heatmaps cover.
+    keypoint_threshold: the threshold for filter the low confident keypoint
+    Returns
+    keypoints: [num_keypoints, 3] for (x , y, valid)
+    """
     keypoints_label = np.argmax(keypoints_prob,1)
     keypoint_score = np.max(keypoints_prob,1)
 
@@ -798,12 +1171,88 @@ def unmold_keypoint_mask(keypoints_prob, bbox, image_shape, mask, keypoint_mask_
     # print("J_y",J_y)
     J_v = np.array(keypoint_score > keypoint_threshold).astype(int)
     keypoints = np.stack([J_x,J_y,J_v],axis=1)
+    return keypoints
+
+def decode_keypoint_heatmaps(keypoints_prob, boxes, keypoint_mask_shape=(56, 56),
+                             method="argmax", window=2):
+    """Decodes the keypoint heatmaps of all instances of an image at once.
+
+    keypoints_prob: [N, num_keypoints, height*width] keypoint probabilities.
+    boxes: [N, (y1, x1, y2, x2)] boxes the heatmaps cover, in image pixels.
+    keypoint_mask_shape: [height, width] of the heatmaps.
+    method: "argmax": The peak cell, rounded to whole pixels like
+                unmold_keypoints().
+            "soft_argmax": Probability weighted mean of the cells within
+                window cells of the peak.
+            "quadratic": Peak refined by fitting a parabola to the log
+                probabilities of the peak and its neighbours on each axis.
+    window: Half size of the soft_argmax window in cells.
 
-    # print("J_v",J_v)
-    full_mask = unmold_mask(mask,bbox,image_shape)
-
-
-    return keypoints, full_mask
+    Returns:
+    keypoints: [N, num_keypoints, (x, y)] image coordinates. Integers for
+        argmax, floats otherwise.
+    scores: [N, num_keypoints] probability of the peak cell.
+    """
+    assert method in ["argmax", "soft_argmax", "quadratic"], \
+        "Unknown keypoint decode method {}".format(method)
+    N, K = keypoints_prob.shape[:2]
+    h, w = keypoint_mask_shape
+    labels = np.argmax(keypoints_prob, axis=2)
+    scores = np.take_along_axis(keypoints_prob, labels[..., None], axis=2)[..., 0]
+    J_y = labels // w
+    J_x = labels % w
+
+    box_height = (boxes[:, 2] - boxes[:, 0]).astype(np.float64)
+    box_width = (boxes[:, 3] - boxes[:, 1]).astype(np.float64)
+    y_scale = (box_height / h)[:, None]
+    x_scale = (box_width / w)[:, None]
+    y_shift = boxes[:, 0, None]
+    x_shift = boxes[:, 1, None]
+
+    if method == "argmax":
+        x = (x_scale * J_x + 0.5).astype(int) + x_shift
+        y = (y_scale * J_y + 0.5).astype(int) + y_shift
+        return np.stack([x, y], axis=2), scores
+
+    heatmaps = keypoints_prob.reshape([N, K, h, w])
+    n = np.arange(N)[:, None, None]
+    k = np.arange(K)[None, :, None]
+    if method == "soft_argmax":
+        d = np.arange(-window, window + 1)
+        ys = J_y[..., None] + d
+        xs = J_x[..., None] + d
+        valid_y = (ys >= 0) & (ys < h)
+        valid_x = (xs >= 0) & (xs < w)
+        ys = np.clip(ys, 0, h - 1)
+        xs = np.clip(xs, 0, w - 1)
+        # [N, K, window rows, window cols]
+        patch = heatmaps[n[..., None], k[..., None], ys[..., :, None], xs[..., None, :]]
+        patch = patch * (valid_y[..., :, None] & valid_x[..., None, :])
+        total = np.sum(patch, axis=(2, 3))
+        total = np.where(total > 0, total, 1)
+        fy = np.sum(patch * ys[..., :, None], axis=(2, 3)) / total
+        fx = np.sum(patch * xs[..., None, :], axis=(2, 3)) / total
+    else:
+        # Parabola through the log probabilities of 3 cells. Peaks on the
+        # border or without curvature keep the cell center.
+        log_heatmaps = np.log(np.maximum(heatmaps, 1e-12))
+        center = log_heatmaps[n[..., 0], k[..., 0], J_y, J_x]
+
+        def refine(J, size, axis_values):
+            before, after = axis_values
+            denom = before - 2 * center + after
+            inside = (J > 0) & (J < size - 1) & (denom < 0)
+            offset = np.where(inside, 0.5 * (before - after) / np.where(inside, denom, -1), 0)
+            return J + np.clip(offset, -0.5, 0.5)
+
+        fy = refine(J_y, h, (log_heatmaps[n[..., 0], k[..., 0], np.maximum(J_y - 1, 0), J_x],
+                             log_heatmaps[n[..., 0], k[..., 0], np.minimum(J_y + 1, h - 1), J_x]))
+        fx = refine(J_x, w, (log_heatmaps[n[..., 0], k[..., 0], J_y, np.maximum(J_x - 1, 0)],
+                             log_heatmaps[n[..., 0], k[..., 0], J_y, np.minimum(J_x + 1, w - 1)]))
+
+    x = x_scale * fx + x_shift
+    y = y_scale * fy + y_shift
+    return np.stack([x, y], axis=2), scores
 
 ############################################################
 #  Anchors
@@ -868,6 +1317,90 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class AnchorLayout(object):
+    """Pyramid anchors together with their grid layout.
+
+    anchors: [N, (y1, x1, y2, x2)] read-only, as generate_pyramid_anchors().
+    level_offsets: [levels + 1] Anchors of level i are
+        anchors[level_offsets[i]:level_offsets[i + 1]].
+    grid_shapes: [levels, (rows, cols)] Anchor locations of each level.
+    anchors_per_location: Number of anchors at each location (ratios).
+    Within a level, the anchor at (row, col) with ratio index r is number
+    (row * cols + col) * anchors_per_location + r.
+    """
+
+    def __init__(self, anchors, scales, ratios, feature_shapes, feature_strides,
+                 anchor_stride):
+        self.anchors = anchors
+        self.scales = list(scales)
+        self.ratios = list(np.array(ratios).flatten())
+        self.feature_strides = list(feature_strides)
+        self.anchor_stride = anchor_stride
+        self.anchors_per_location = len(self.ratios)
+        self.grid_shapes = np.array(
+            [[int(math.ceil(shape[0] / anchor_stride)),
+              int(math.ceil(shape[1] / anchor_stride))]
+             for shape in feature_shapes])
+        counts = self.grid_shapes[:, 0] * self.grid_shapes[:, 1] * self.anchors_per_location
+        self.level_offsets = np.concatenate([[0], np.cumsum(counts)])
+        assert self.level_offsets[-1] == anchors.shape[0], \
+            "Anchors don't match the pyramid layout"
+
+    def level_anchors(self, level):
+        """Returns the [n, (y1, x1, y2, x2)] anchors of a pyramid level."""
+        return self.anchors[self.level_offsets[level]:self.level_offsets[level + 1]]
+
+    def anchor_levels(self, anchor_ids):
+        """Returns the pyramid level of each of the given anchor indices."""
+        return np.searchsorted(self.level_offsets, anchor_ids, side="right") - 1
+
+
+# Anchors of this process, keyed by the generate_pyramid_anchors() arguments
+_anchor_cache = {}
+
+
+def get_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
+                        anchor_stride, cache_dir=None):
+    """Returns the AnchorLayout of generate_pyramid_anchors() with these
+    arguments. Anchors are generated once per process and shared, so don't
+    modify them.
+
+    cache_dir: Optional directory where the anchors are also saved as .npy
+        files, so other processes and runs load them instead.
+    """
+    key = (tuple(float(s) for s in scales),
+           tuple(float(r) for r in np.array(ratios).flatten()),
+           tuple(tuple(int(d) for d in shape) for shape in feature_shapes),
+           tuple(int(s) for s in feature_strides),
+           int(anchor_stride))
+    layout = _anchor_cache.get(key)
+    if layout is not None:
+        return layout
+
+    anchors = None
+    if cache_dir:
+        path = os.path.join(cache_dir, "anchors_{}.npy".format(
+            hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]))
+        if os.path.exists(path):
+            anchors = np.load(path)
+    if anchors is None:
+        anchors = generate_pyramid_anchors(scales, ratios, feature_shapes,
+                                           feature_strides, anchor_stride)
+        if cache_dir:
+            # Write to a temporary name first so readers never see a
+            # partial file.
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "{}.{}.tmp.npy".format(path[:-4], os.getpid())
+            np.save(tmp_path, anchors)
+            os.replace(tmp_path, path)
+    anchors.flags.writeable = False
+
+    layout = AnchorLayout(anchors, scales, ratios, feature_shapes,
+                          feature_strides, anchor_stride)
+    _anchor_cache[key] = layout
+    return layout
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -1,7 +1,121 @@
 import glob
+import os
+import threading
+from collections import OrderedDict
 import cv2
 import pdb
 
+
+class VideoCapturePool:
+    """Process-wide pool of open cv2.VideoCapture handles keyed by path.
+
+    Opening an AVI and seeking to a keyframe is far more expensive than
+    decoding a single frame, so handles are kept open between reads and
+    evicted least-recently-used once more than max_open files are in use.
+    The pool also caches (frame count, fps) per file and remembers the
+    position of every handle, so a read of the frame that directly follows
+    the previous one is served without a seek.
+    """
+
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+        self._readers = OrderedDict()  # path -> [reader, next frame position]
+        self._metadata = {}            # path -> (frame_count, fps)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Counters, useful to check that training reads are sequential
+        self.opens = 0
+        self.seeks = 0
+        self.sequential_reads = 0
+
+    def _check_pid(self):
+        # Capture handles can't be shared with a forked worker process.
+        # Drop the inherited ones and let the child open its own.
+        if self._pid != os.getpid():
+            self._readers = OrderedDict()
+            self._pid = os.getpid()
+
+    def _acquire(self, path):
+        """Returns the [reader, position] entry of path, opening it if needed.
+        Must be called with the lock held.
+        """
+        self._check_pid()
+        entry = self._readers.pop(path, None)
+        if entry is None:
+            while self._readers and len(self._readers) >= self.max_open:
+                _, (old_reader, _) = self._readers.popitem(last=False)
+                old_reader.release()
+            entry = [cv2.VideoCapture(path), 0]
+            self.opens += 1
+        # Most recently used goes last
+        self._readers[path] = entry
+        return entry
+
+    def metadata(self, path):
+        """Returns (frame_count, fps) of the given video file."""
+        with self._lock:
+            if path not in self._metadata:
+                reader = self._acquire(path)[0]
+                self._metadata[path] = (int(reader.get(cv2.CAP_PROP_FRAME_COUNT)),
+                                        reader.get(cv2.CAP_PROP_FPS))
+            return self._metadata[path]
+
+    def read(self, path, position):
+        """Decodes the frame at the given 0-based position of a video file.
+        Returns the BGR frame or None if it can't be read.
+        """
+        with self._lock:
+            entry = self._acquire(path)
+            reader = entry[0]
+            if position < 0 or position != entry[1]:
+                reader.set(cv2.CAP_PROP_POS_FRAMES, position)
+                self.seeks += 1
+            else:
+                self.sequential_reads += 1
+            ret, frame = reader.read()
+            # Only trust the tracked position after a successful read
+            # of a valid frame index.
+            entry[1] = position + 1 if ret and position >= 0 else -1
+            return frame if ret else None
+
+    def release(self):
+        """Closes all open handles. Cached metadata is kept."""
+        with self._lock:
+            self._check_pid()
+            for reader, _ in self._readers.values():
+                reader.release()
+            self._readers = OrderedDict()
+
+
+_capture_pool = None
+
+
+def get_capture_pool():
+    """Returns the process-wide VideoCapturePool."""
+    global _capture_pool
+    if _capture_pool is None:
+        _capture_pool = VideoCapturePool()
+    return _capture_pool
+
+
+def split_frame(frame, side):
+    """Returns the left ('L') or right ('R') half of a side-by-side frame
+    converted from BGR to RGB.
+    """
+    image = frame[:, :int(frame.shape[1] / 2), :] if side == 'L' else frame[:, int(frame.shape[1] / 2):, :]
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def read_frame(path, framenumber, side):
+    """Reads one half of a frame through the shared capture pool. framenumber
+    follows the convention of Dataset_from_videos.get_frame().
+    """
+    frame = get_capture_pool().read(path, framenumber - 1)
+    if frame is None:
+        raise IOError("Could not read frame {} of {}".format(framenumber, path))
+    return split_frame(frame, side)
+
+
 class Dataset_from_videos:
     def __init__(self, avi_list):
         assert isinstance(avi_list, list), 'avi_list should be a list!'
@@ -18,9 +132,11 @@ class Dataset_from_videos:
 
         # Set total number of frames
         tot_count = 0
+        pool = get_capture_pool()
         for avi_file in self.avi_list:
-            tot_count += int(cv2.VideoCapture(avi_file).get(cv2.CAP_PROP_FRAME_COUNT))
-            self._framerates.append(cv2.VideoCapture(avi_file).get(cv2.CAP_PROP_FPS))
+            frame_count, fps = pool.metadata(avi_file)
+            tot_count += frame_count
+            self._framerates.append(fps)
             # tot_count += int(cv2.VideoCapture(avi_file).get(cv2.cv.CAP_PROP_FRAME_COUNT))
         self.tot_frames = tot_count * 2 # Due to left and right image
 
@@ -115,14 +231,12 @@ class Dataset_from_videos:
         '''
         Works only for the current videofile (first if not specified)
         '''
-        self.cur_reader.set(cv2.CAP_PROP_POS_FRAMES, framenumber - 1)
-        ret, frame = self.cur_reader.read()
+        avi_file = self.avi_list[max(self._cur_index, 0)]
+        frame = get_capture_pool().read(avi_file, framenumber - 1)
         if frame is None:
             pdb.set_trace()
-        image = frame[:, :int(frame.shape[1] / 2), :] if side == 'L' else frame[:, int(frame.shape[1] / 2):, :]
-        # Convert colorspace
-        rgb = cv2.cvtColor(image,cv2.COLOR_BGR2RGB)
-        return rgb
+        # Split and convert colorspace
+        return split_frame(frame, side)
 
     cur_reader = property(fget=get_cur_reader)
     cur_avi_file = property(fget=get_cur_avi_file)
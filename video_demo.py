@@ -3,9 +3,9 @@ import numpy as np
 import coco
 import model as modellib
 import visualize
-from model import log
 import cv2
 import time
+from video_pipeline import VideoPipeline, read_frames
 
 ROOT_DIR = os.getcwd()
 # Directory to save logs and trained model
@@ -19,18 +19,6 @@ class InferenceConfig(coco.CocoConfig):
 
 inference_config = InferenceConfig()
 
-# Recreate the model in inference mode
-model = modellib.MaskRCNN(mode="inference",
-                          config=inference_config,
-                          model_dir=MODEL_DIR)
-
-# Get path to saved weights
-
-model_path = os.path.join(ROOT_DIR, "mask_rcnn_coco_humanpose.h5")
-assert model_path != "", "Provide path to trained weights"
-print("Loading weights from ", model_path)
-model.load_weights(model_path, by_name=True)
-
 class_names = ['BG', 'person']
 def cv2_display_keypoint(image,boxes,keypoints,masks,class_ids,scores,class_names,skeleton = inference_config.LIMBS):
     # Number of persons
@@ -85,42 +73,62 @@ def cv2_display_keypoint(image,boxes,keypoints,masks,class_ids,scores,class_name
                     0.5, color)
     return image
 
-cap = cv2.VideoCapture('humantest2.avi')
-size = (
-	int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
-	int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-)
-codec = cv2.VideoWriter_fourcc(*'DIVX')
-output = cv2.VideoWriter('human2.avi',codec,25.0,size)
 
-i = 0
-frame_rate_divider = 1
-while(cap.isOpened()):
-    stime = time.time()
-    ret, frame = cap.read()
-    if ret:
-        if i % frame_rate_divider == 0:
-            results = model.detect_keypoint([frame], verbose=0)
-            r = results[0]
-         # for one image
-            log("rois", r['rois'])
-            log("keypoints", r['keypoints'])
-            log("class_ids", r['class_ids'])
-            log("keypoints", r['keypoints'])
-            log("masks", r['masks'])
-            log("scores", r['scores'])
-            result_frame = cv2_display_keypoint(frame,r['rois'],r['keypoints'],r['masks'],r['class_ids'],r['scores'],class_names)
-            output.write(result_frame)
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Run keypoint detection on a video and write the rendered frames.')
+    parser.add_argument('--input', required=False, default='humantest2.avi',
+                        metavar="/path/to/input.avi", help='Input video')
+    parser.add_argument('--output', required=False, default='human2.avi',
+                        metavar="/path/to/output.avi", help='Rendered output video')
+    parser.add_argument('--weights', required=False, default=COCO_MODEL_PATH,
+                        metavar="/path/to/weights.h5", help='Path to weights .h5 file')
+    parser.add_argument('--images-per-gpu', required=False, default=1, type=int,
+                        help='Frames per predict() call')
+    parser.add_argument('--queue-size', required=False, default=8, type=int,
+                        help='Capacity of the queues between pipeline stages')
+    parser.add_argument('--unmold-workers', required=False, default=2, type=int,
+                        help='Threads unmolding detections')
+    parser.add_argument('--show', action='store_true',
+                        help='Show the rendered frames while processing')
+    args = parser.parse_args()
+
+    inference_config.IMAGES_PER_GPU = args.images_per_gpu
+    inference_config.BATCH_SIZE = inference_config.IMAGES_PER_GPU * inference_config.GPU_COUNT
+
+    # Recreate the model in inference mode
+    model = modellib.MaskRCNN(mode="inference",
+                              config=inference_config,
+                              model_dir=MODEL_DIR)
+    print("Loading weights from ", args.weights)
+    model.load_weights(args.weights, by_name=True)
+
+    cap = cv2.VideoCapture(args.input)
+    size = (
+        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    )
+    codec = cv2.VideoWriter_fourcc(*'DIVX')
+    output = cv2.VideoWriter(args.output, codec, 25.0, size)
+    pipeline = VideoPipeline(model, queue_size=args.queue_size,
+                             unmold_workers=args.unmold_workers)
+
+    def render(i, frame, r):
+        result_frame = cv2_display_keypoint(frame, r['rois'], r['keypoints'], r['masks'],
+                                            r['class_ids'], r['scores'], class_names)
+        output.write(result_frame)
+        if args.show:
             cv2.imshow('frame', result_frame)
-            i += 1
-        else:
-            i += 1
-        print('FPS {:.1f}'.format(1 / (time.time() - stime)))
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                pipeline.stop()
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-    else:
-        break
-cap.release()
-output.release()
-cv2.destroyAllWindows()
+    stime = time.time()
+    count = pipeline.run(read_frames(cap), render)
+    print("{} frames in {:.1f}s".format(count, time.time() - stime))
+    for stage, fps in sorted(pipeline.stats().items()):
+        print('{:8s} FPS {:.1f}'.format(stage, fps))
+    cap.release()
+    output.release()
+    cv2.destroyAllWindows()
@@ -0,0 +1,299 @@
+"""
+Mask R-CNN
+Pipelined video inference.
+
+Running decode, detect_keypoint() and drawing in sequence leaves the CPU
+idle while the GPU predicts and the other way round. VideoPipeline runs
+each step on its own stage, connected by bounded queues:
+
+    decode   One thread reads frames and molds them into batches with
+             mold_inputs().
+    predict  One thread runs keras_model.predict() on the molded batches.
+    unmold   A thread pool turns the network outputs of each frame into a
+             detect_keypoint() result dict.
+    render   One thread waits for the results in frame order and passes
+             them to a sink, which typically draws and encodes the frame.
+
+The bounded queues make a fast stage wait for a slow one instead of
+buffering the whole video. Frames reach the sink in input order.
+
+Usage:
+    pipeline = VideoPipeline(model, queue_size=8, unmold_workers=2)
+    pipeline.run(read_frames(cv2.VideoCapture("input.avi")), sink)
+    print(pipeline.stats())
+"""
+
+import time
+import threading
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+# Marks the end of the stream in the stage queues
+_END = object()
+
+
+def read_frames(capture):
+    """Yields the frames of an open cv2.VideoCapture until it ends."""
+    while capture.isOpened():
+        ret, frame = capture.read()
+        if not ret:
+            break
+        yield frame
+
+
+class StageStats(object):
+    """Frame count and busy time of one stage. Busy time excludes the time
+    spent waiting on the neighbouring queues.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.busy = 0.0
+
+    def add(self, frames, seconds):
+        self.frames += frames
+        self.busy += seconds
+
+    def fps(self):
+        return self.frames / self.busy if self.busy else 0.0
+
+
+class VideoPipeline(object):
+    """Streams frames through a MaskRCNN inference model.
+
+    model: MaskRCNN in inference mode.
+    queue_size: Capacity of each queue between stages, in batches for the
+        decode and predict stages and in frames for the render stage.
+    unmold_workers: Number of threads unmolding detections.
+    to_rgb: If True, frames are converted from BGR (OpenCV order) to RGB
+        before they are molded. The sink still receives the original frame.
+    mask_mode: "full", "box" or "none", as in detect_keypoint().
+    """
+
+    def __init__(self, model, queue_size=8, unmold_workers=2, to_rgb=False,
+                 mask_mode="full"):
+        assert model.mode == "inference", "Create model in inference mode."
+        self.model = model
+        self.config = model.config
+        self.queue_size = queue_size
+        self.unmold_workers = unmold_workers
+        self.to_rgb = to_rgb
+        self.mask_mode = mask_mode
+
+        # predict() runs in a worker thread. Build the predict function here
+        # and remember the graph of the model.
+        model.keras_model._make_predict_function()
+        self._graph = tf.get_default_graph()
+        self._stats = {}
+        self._errors = []
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._elapsed = 0.0
+
+    def stop(self):
+        """Stops reading frames. Frames already read are still rendered."""
+        self._stop.set()
+
+    def run(self, frames, sink):
+        """Runs all frames through the pipeline and blocks until the sink
+        has received the last one.
+
+        frames: Iterable of [height, width, 3] frames. It's iterated in the
+            decode thread, so it can read from a video file or camera.
+        sink: Called as sink(frame_index, frame, result) in frame order from
+            the render thread. result is a detect_keypoint() result dict.
+
+        Returns the number of frames processed.
+        """
+        self._stats = {name: StageStats() for name in ["decode", "predict", "unmold", "render"]}
+        self._errors = []
+        self._stop.clear()
+        molded_queue = queue.Queue(maxsize=self.queue_size)
+        predicted_queue = queue.Queue(maxsize=self.queue_size)
+        render_queue = queue.Queue(maxsize=self.queue_size * self.config.BATCH_SIZE)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.unmold_workers) as pool:
+            threads = [
+                threading.Thread(target=self._decode, args=(frames, molded_queue),
+                                 name="VideoPipeline-decode"),
+                threading.Thread(target=self._predict, args=(molded_queue, predicted_queue),
+                                 name="VideoPipeline-predict"),
+                threading.Thread(target=self._unmold, args=(predicted_queue, render_queue, pool),
+                                 name="VideoPipeline-unmold"),
+                threading.Thread(target=self._render, args=(render_queue, sink),
+                                 name="VideoPipeline-render"),
+            ]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                t.join()
+        self._elapsed = time.time() - start
+        if self._errors:
+            raise self._errors[0]
+        return self._stats["render"].frames
+
+    def stats(self):
+        """Returns frames per second of each stage's busy time, plus the
+        end-to-end rate of the last run().
+        """
+        stats = {name: stage.fps() for name, stage in self._stats.items()}
+        if self._stats:
+            stats["total"] = self._stats["render"].frames / self._elapsed \
+                if self._elapsed else 0.0
+        return stats
+
+    def _fail(self, e):
+        """Records an error and stops the pipeline."""
+        logging.exception("Error in video pipeline")
+        self._errors.append(e)
+        self._stop.set()
+
+    def _put(self, q, item):
+        """Puts an item on a bounded queue. Gives up if the pipeline failed,
+        so a stage stops producing once its results would be discarded.
+        """
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if self._errors:
+                    return False
+
+    def _end(self, q):
+        """Puts the end marker on a queue. Unlike _put() it never gives up:
+        every stage reads its queue up to the end marker, even after a
+        failure, so the marker always finds room eventually.
+        """
+        q.put(_END)
+
+    def _drain(self, q):
+        """Discards the items of a queue up to the end marker."""
+        while q.get() is not _END:
+            pass
+
+    def _decode(self, frames, molded_queue):
+        """Reads frames and molds them in batches of BATCH_SIZE."""
+        batch = []
+        try:
+            t = time.time()
+            for frame in frames:
+                batch.append(frame)
+                if len(batch) == self.config.BATCH_SIZE:
+                    item = self._mold(batch)
+                    self._stats["decode"].add(len(batch), time.time() - t)
+                    if not self._put(molded_queue, item):
+                        return
+                    batch = []
+                    t = time.time()
+                if self._stop.is_set():
+                    break
+            if batch:
+                item = self._mold(batch)
+                self._stats["decode"].add(len(batch), time.time() - t)
+                self._put(molded_queue, item)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._end(molded_queue)
+
+    def _mold(self, frames):
+        """Molds a batch of frames. Pads a partial batch with copies of its
+        last image, like detect_keypoint().
+        """
+        images = [frame[:, :, ::-1] if self.to_rgb else frame for frame in frames]
+        molded_images, image_metas, windows = self.model.mold_inputs(images)
+        padding = self.config.BATCH_SIZE - len(frames)
+        if padding:
+            molded_images = np.concatenate(
+                [molded_images, np.repeat(molded_images[-1:], padding, axis=0)])
+            image_metas = np.concatenate(
+                [image_metas, np.repeat(image_metas[-1:], padding, axis=0)])
+        return frames, molded_images, image_metas, windows
+
+    def _predict(self, molded_queue, predicted_queue):
+        """Runs the model on each molded batch."""
+        ended = False
+        try:
+            with self._graph.as_default():
+                while True:
+                    item = molded_queue.get()
+                    if item is _END:
+                        ended = True
+                        break
+                    if self._errors:
+                        continue
+                    frames, molded_images, image_metas, windows = item
+                    t = time.time()
+                    outputs = self.model.keras_model.predict([molded_images, image_metas],
+                                                             verbose=0)
+                    self._stats["predict"].add(len(frames), time.time() - t)
+                    if not self._put(predicted_queue, (frames, windows, outputs)):
+                        break
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._end(predicted_queue)
+            if not ended:
+                self._drain(molded_queue)
+
+    def _unmold_one(self, frame, window, detections, mrcnn_mask, mrcnn_keypoint_prob):
+        t = time.time()
+        result = self.model.keypoint_result(detections, mrcnn_keypoint_prob,
+                                            frame.shape, window, mrcnn_mask,
+                                            self.mask_mode)
+        with self._stats_lock:
+            self._stats["unmold"].add(1, time.time() - t)
+        return result
+
+    def _unmold(self, predicted_queue, render_queue, pool):
+        """Submits each frame of a predicted batch to the unmold pool and
+        queues the futures for the render stage in frame order.
+        """
+        ended = False
+        try:
+            while True:
+                item = predicted_queue.get()
+                if item is _END:
+                    ended = True
+                    break
+                if self._errors:
+                    continue
+                frames, windows, outputs = item
+                detections, _, _, _, _, _, mrcnn_mask, mrcnn_keypoint_prob = outputs
+                for i, frame in enumerate(frames):
+                    future = pool.submit(self._unmold_one, frame, windows[i], detections[i],
+                                         mrcnn_mask[i], mrcnn_keypoint_prob[i])
+                    if not self._put(render_queue, (frame, future)):
+                        return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._end(render_queue)
+            if not ended:
+                self._drain(predicted_queue)
+
+    def _render(self, render_queue, sink):
+        """Passes the results to the sink in frame order."""
+        index = 0
+        while True:
+            item = render_queue.get()
+            if item is _END:
+                break
+            if self._errors:
+                continue
+            frame, future = item
+            try:
+                result = future.result()
+                t = time.time()
+                sink(index, frame, result)
+                self._stats["render"].add(1, time.time() - t)
+            except Exception as e:
+                self._fail(e)
+            index += 1